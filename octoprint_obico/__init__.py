@@ -1,10 +1,8 @@
 # coding=utf-8
 from __future__ import absolute_import
-import bson
 import logging
 import threading
 import sarge
-import json
 import re
 import os
 import sys
@@ -27,7 +25,13 @@ from .utils import (
     server_request, migrate_tsd_settings,)
 from .lib.error_stats import error_stats
 from .lib import alert_queue
-from .print_job_tracker import PrintJobTracker
+from .lib.moving_histogram import MovingHistogram
+from .lib.event_spool import EventSpool, is_event_msg
+from .lib.timeseries import TimeSeriesStore, series_from_status, is_active, encode_window
+from .lib import serializer
+from .lib import debug_log
+from .print_job_tracker import PrintJobTracker, FILE_METADATA_EVENTS
+from .status_push import StatusPusher, StatusPushCallback
 from .remote_status import RemoteStatus
 from .webcam_capture import JpegPoster, capture_jpeg
 from .file_downloader import FileDownloader
@@ -46,8 +50,7 @@ import octoprint.plugin
 __python_version__ = 3 if sys.version_info >= (3, 0) else 2
 
 _logger = logging.getLogger('octoprint.plugins.obico')
-
-POST_STATUS_INTERVAL_SECONDS = 50.0
+_hot_path_logger = debug_log.SampledDebugLogger(_logger)
 
 DEFAULT_LINKED_PRINTER = {'is_pro': False}
 
@@ -72,8 +75,8 @@ class ObicoPlugin(
         self.ss = None
         self.status_posted_to_server_ts = 0
         self.message_queue_to_server = queue.Queue(maxsize=1000)
-        self.status_update_booster = 0    # update status at higher frequency when self.status_update_booster > 0
-        self.status_update_lock = threading.RLock()
+        self.status_pusher = StatusPusher(on_state_change=_print_job_tracker.mark_dirty)
+        self.status_push_callback = StatusPushCallback(self.status_pusher)
         self.remote_status = RemoteStatus()
         self.pause_resume_sequence = PauseResumeGCodeSequence()
         self.gcode_hooks = GCodeHooks(self, _print_job_tracker)
@@ -91,6 +94,12 @@ class ObicoPlugin(
         self.nozzlecam = NozzleCam(self)
         self.webcam_streamer = WebcamStreamer(self)
         self.display_status = None
+        self.server_ws_rtt = MovingHistogram()
+        self.event_spool = None
+        self.event_spool_lock = threading.RLock()  # Held while events move between the message queue and the spool
+        self.timeseries = TimeSeriesStore()    # passthru target for temperature/progress charts
+        self.telemetry_sent_until_ts = 0
+        self.telemetry_active = False
 
 
     # ~~ Custom event registration
@@ -109,6 +118,14 @@ class ObicoPlugin(
             sentry_opt='out',
             webcams=[],
             nozzle_camera='',
+            server_ws_ping_interval=20,
+            server_ws_dead_after=60,
+            debug_log_sample_every=1,
+            tunnel_workers=4,
+            tunnel_max_queue_size=200,
+            tunnel_trace_file=False,
+            status_snapshot_tick=0.5,
+            received_gcode_patterns=[],     # e.g. [{'signal': 'paused', 'pattern': 'echo:Insert filament'}]
         )
 
     def on_settings_save(self, data):
@@ -189,6 +206,12 @@ class ObicoPlugin(
                     self.post_update_to_server(data=event_payload)
             elif event == 'FilamentChange':
                 run_in_thread(self.post_filament_change_event)
+            elif event in FILE_METADATA_EVENTS:
+                payload = payload or {}
+                _print_job_tracker.file_metadata_cache.invalidate(payload.get('storage') or payload.get('origin'), payload.get('path'))
+            elif event.startswith('plugin_pluginmanager_'):
+                if self.local_tunnel:
+                    self.local_tunnel.response_cache.invalidate()    # Installed/enabled plugins change the bundled assets
         except Exception as e:
             self.sentry.captureException()
     # ~~Shutdown Plugin
@@ -201,6 +224,11 @@ class ObicoPlugin(
             self.webcam_streamer.shutdown()
         if self.client_conn:
             self.client_conn.close()
+        if self.event_spool:
+            self.event_spool.close()
+        if self.local_tunnel:
+            self.local_tunnel.close()
+        self._printer.unregister_callback(self.status_push_callback)
 
 
     # ~~Startup Plugin
@@ -221,6 +249,9 @@ class ObicoPlugin(
         migrate_tsd_settings(self)
 
         self.octoprint_port = port if port else self._settings.getInt(["server", "port"])
+        debug_log.set_sample_rate(self._settings.get_int(["debug_log_sample_every"]))
+        _print_job_tracker.snapshot_tick = self._settings.get_float(["status_snapshot_tick"])
+        self.gcode_hooks.configure_line_patterns(self._settings.get(["received_gcode_patterns"]))
 
     def on_after_startup(self):
         if self.bailed_because_tsd_plugin_running:
@@ -264,12 +295,20 @@ class ObicoPlugin(
             on_http_response=self.send_ws_msg_to_server,
             on_ws_message=self.send_ws_msg_to_server,
             data_dir=self.get_plugin_data_folder(),
-            sentry=self.sentry)
+            sentry=self.sentry,
+            workers=self._settings.get_int(["tunnel_workers"]),
+            max_queue_size=self._settings.get_int(["tunnel_max_queue_size"]),
+            outbound_backlog=self.message_queue_to_server.qsize,
+            cache_version='{}/{}'.format(octoprint.util.version.get_octoprint_version_string(), self._plugin_version),
+            trace_path=os.path.join(self.get_plugin_data_folder(), 'tunnel_trace.jsonl') if self._settings.get_boolean(["tunnel_trace_file"]) else None)
+
+        self.event_spool = EventSpool(os.path.join(self.get_plugin_data_folder(), '.event_spool.jsonl'))
 
         jpeg_post_thread = threading.Thread(target=self.jpeg_poster.pic_post_loop)
         jpeg_post_thread.daemon = True
         jpeg_post_thread.start()
 
+        self._printer.register_callback(self.status_push_callback)    # Status changes are pushed instead of polled
         status_update_to_client_thread = threading.Thread(target=self.status_update_to_client_loop)
         status_update_to_client_thread.daemon = True
         status_update_to_client_thread.start()
@@ -280,13 +319,17 @@ class ObicoPlugin(
 
         while True:
             try:
-                interval_in_seconds = POST_STATUS_INTERVAL_SECONDS
-                if self.status_update_booster > 0:
-                    interval_in_seconds /= 5
-
-                if self.status_posted_to_server_ts < time.time() - interval_in_seconds:
+                if self.status_pusher.server_push_due(self.status_posted_to_server_ts):
                     self.post_update_to_server()
 
+                values = series_from_status(_print_job_tracker.status(self, status_only=True)['status'], fan_speed=_print_job_tracker.fan_speed)
+                self.timeseries.add(time.time(), values)
+                self.telemetry_active = self.telemetry_active or is_active(values)
+                if self.status_pusher.telemetry_due():
+                    self.post_telemetry_to_server()
+
+                self.event_spool.sync()
+
             except Exception as e:
                 self.sentry.captureException()
 
@@ -319,7 +362,7 @@ class ObicoPlugin(
         server_ws_backoff = ExpoBackoff(300)
         while self.shutting_down is False:
             try:
-                (data, as_binary) = self.message_queue_to_server.get()
+                (data, as_binary, enqueued_ts, on_sent) = self.message_queue_to_server.get()
 
                 if not self.is_configured():
                     _logger.warning("Plugin not configured. Not sending message to server...")
@@ -332,27 +375,45 @@ class ObicoPlugin(
                 error_stats.attempt('server')
 
                 if not self.ss or not self.ss.connected():
-                    self.ss = WebSocketClient(self.canonical_ws_prefix() + "/ws/dev/", token=self.auth_token(), on_ws_msg=self.process_server_msg, on_ws_close=on_server_ws_close, on_ws_open=on_server_ws_open)
+                    # Spooled now, behind older spooled events and ahead of newer ones, it is replayed in order with them
+                    with self.event_spool_lock:
+                        if self.spool_if_event(data):
+                            data = None
+
+                    self.ss = WebSocketClient(
+                        self.canonical_ws_prefix() + "/ws/dev/",
+                        token=self.auth_token(),
+                        on_ws_data=self.process_server_msg,
+                        on_ws_close=on_server_ws_close,
+                        on_ws_open=on_server_ws_open,
+                        ping_interval=self._settings.get_float(["server_ws_ping_interval"]),
+                        dead_after=self._settings.get_float(["server_ws_dead_after"]),
+                        rtt_histogram=self.server_ws_rtt)
+                    self.replay_spooled_events()
+                    server_ws_backoff.reset()
+
+                if data is None:
+                    continue
 
+                raw = serializer.dumps(data, as_binary=as_binary)
                 if as_binary:
-                    raw = bson.dumps(data)
-                    _logger.debug("Sending binary ({} bytes) to server".format(len(raw)))
+                    _hot_path_logger.debug("Sending binary (%d bytes) to server", len(raw))
                 else:
-                    _logger.debug("Sending to server: \n{}".format(data))
-                    if __python_version__ == 3:
-                        raw = json.dumps(data, default=str)
-                    else:
-                        raw = json.dumps(data, encoding='iso-8859-1', default=str)
+                    _hot_path_logger.debug("Sending to server: \n%s", data)
                 self.ss.send(raw, as_binary=as_binary)
+                if on_sent:
+                    on_sent(len(raw), time.time() - enqueued_ts)
                 server_ws_backoff.reset()
             except WebSocketConnectionException as e:
                 _logger.warning(e)
+                self.spool_unsent_events(data)
                 error_stats.add_connection_error('server', self)
                 if self.ss:
                     self.ss.close()
                 server_ws_backoff.more(e)
             except Exception as e:
                 self.sentry.captureException()
+                self.spool_unsent_events(data)
                 error_stats.add_connection_error('server', self)
                 if self.ss:
                     self.ss.close()
@@ -363,26 +424,94 @@ class ObicoPlugin(
             data = _print_job_tracker.status(self)
         self.send_ws_msg_to_server(data)
         self.status_posted_to_server_ts = time.time()
+        self.status_pusher.server_pushed()
+
+    def post_telemetry_to_server(self):
+        # One columnar, compressed batch of the 1 s samples since the last one. Idle printers don't send any.
+        (timestamps, columns) = self.timeseries.samples_since(self.telemetry_sent_until_ts)
+        if not timestamps:
+            return
+        self.telemetry_sent_until_ts = timestamps[-1]
+
+        if self.telemetry_active:
+            telemetry = encode_window(1, timestamps, columns)
+            telemetry['current_print_ts'] = _print_job_tracker.current_print_ts
+            self.send_ws_msg_to_server({'telemetry': telemetry})
+        self.telemetry_active = False
+
+    def send_ws_msg_to_server(self, data, as_binary=False, on_sent=None):
+        # on_sent(serialized size, seconds spent in the queue) is called once the message is handed to the websocket
+        # Events are spooled to disk while the server is unreachable, so that they are not lost. Everything else is allowed to drop.
+        # Until the spool is replayed, later events go to the spool too, so that the server gets them in order.
+        if self.event_spool and is_event_msg(data) and (not (self.ss and self.ss.connected()) or not self.event_spool.is_empty()):
+            with self.event_spool_lock:
+                self.spool_queued_events()
+                self.spool_if_event(data)
+            return
 
-    def send_ws_msg_to_server(self, data, as_binary=False):
         try:
-            self.message_queue_to_server.put_nowait((data, as_binary))
+            self.message_queue_to_server.put_nowait((data, as_binary, time.time(), on_sent))
         except queue.Full:
+            if self.event_spool and is_event_msg(data):
+                with self.event_spool_lock:
+                    self.spool_queued_events()  # Older than data, and they would overtake the spool otherwise
+                    self.spool_if_event(data)
+                return
             _logger.warning("Server message queue is full, msg dropped")
 
-    def process_server_msg(self, ws, raw_data):
-        global _print_job_tracker
+    def spool_if_event(self, data):
+        if not self.event_spool or not is_event_msg(data):
+            return False
         try:
-            # raw_data can be both json or bson
-            # no py2 compat way to properly detect type here
-            # (w/o patching ws lib)
+            self.event_spool.append(data)
+        except Exception:
+            self.sentry.captureException()
+        return True
+
+    def spool_unsent_events(self, data):
+        # data failed to send. The events still in the queue are newer than it.
+        with self.event_spool_lock:
+            self.spool_if_event(data)
+            self.spool_queued_events()
+
+    def spool_queued_events(self):
+        # Move the events waiting in the message queue to the spool, in order. Other messages stay in the queue.
+        others = []
+        while True:
             try:
-                msg = json.loads(raw_data)
-                _logger.debug('Received: ' + raw_data)
-            except ValueError:
-                msg = bson.loads(raw_data)
-                _logger.debug(
-                    'received binary message ({} bytes)'.format(len(raw_data)))
+                item = self.message_queue_to_server.get_nowait()
+            except queue.Empty:
+                break
+            if not self.spool_if_event(item[0]):
+                others.append(item)
+
+        for item in others:
+            try:
+                self.message_queue_to_server.put_nowait(item)
+            except queue.Full:
+                break
+
+    def replay_spooled_events(self):
+        # Sent right away on the new connection, before anything in the message queue, which is all newer
+        events = self.event_spool.drain()
+        if events:
+            _logger.info('Replaying {} spooled event(s) to server'.format(len(events)))
+        for (i, data) in enumerate(events):
+            try:
+                self.ss.send(serializer.dumps(data))
+            except Exception:
+                self.event_spool.restore(events[i:])
+                raise
+
+    def process_server_msg(self, ws, raw_data, opcode=None):
+        global _print_job_tracker
+        try:
+            # raw_data can be both json or bson. The websocket opcode tells which one it is.
+            msg = serializer.loads(raw_data, opcode)
+            if isinstance(raw_data, bytes):
+                _hot_path_logger.debug('received binary message (%d bytes)', len(raw_data))
+            else:
+                _hot_path_logger.debug('Received: %s', raw_data)
 
             need_status_boost = False
             for command in msg.get('commands', []):
@@ -418,20 +547,10 @@ class ObicoPlugin(
                     self.jpeg_poster.need_viewing_boost.set()
 
             if msg.get('http.tunnel') and self.local_tunnel:
-                kwargs = msg.get('http.tunnel')
-                tunnel_thread = threading.Thread(
-                    target=self.local_tunnel.send_http_to_local,
-                    kwargs=kwargs)
-                tunnel_thread.is_daemon = True
-                tunnel_thread.start()
+                self.local_tunnel.enqueue_http_to_local(**msg.get('http.tunnel'))
 
             if msg.get('http.tunnelv2') and self.local_tunnel:
-                kwargs = msg.get('http.tunnelv2')
-                tunnel_thread = threading.Thread(
-                    target=self.local_tunnel.send_http_to_local_v2,
-                    kwargs=kwargs)
-                tunnel_thread.is_daemon = True
-                tunnel_thread.start()
+                self.local_tunnel.enqueue_http_to_local_v2(**msg.get('http.tunnelv2'))
 
             if msg.get('ws.tunnel') and self.local_tunnel:
                 kwargs = msg.get('ws.tunnel')
@@ -445,20 +564,20 @@ class ObicoPlugin(
 
     def status_update_to_client_loop(self):
         while self.shutting_down is False:
-            interval = 0.75 if self.status_update_booster > 0 else 2
-            time.sleep(interval)
-            self.post_printer_status_to_client()
-            with self.status_update_lock:
-                self.status_update_booster -= 1
+            changed_ts = self.status_pusher.wait_for_client_push()
+            self.post_printer_status_to_client(changed_ts=changed_ts)
+
+    def file_metadata_cache_stats(self):
+        return _print_job_tracker.file_metadata_cache.stats()
 
-    def post_printer_status_to_client(self):
-        status = _print_job_tracker.status(self, status_only=True)
-        self.client_conn.send_msg_to_client({'status': status.get('status', {})})
+    def post_printer_status_to_client(self, changed_ts=None):
+        self.client_conn.send_msg_to_client(_print_job_tracker.status_snapshot(self, changed_ts=changed_ts).client_message())
 
     def boost_status_update(self):
-        self.post_printer_status_to_client()
-        with self.status_update_lock:
-            self.status_update_booster = 20
+        # Something happened (an event, a passthru call). Let clients know soon, with a fresh snapshot. The server is told
+        # about state transitions by the printer callback, and gets the rest as telemetry
+        _print_job_tracker.mark_dirty()
+        self.status_pusher.mark_dirty()
 
     def post_printer_event_to_server(self, event_data, attach_snapshot=False, spam_tolerance_seconds=60*60*24*1000):
         event_title = event_data['event_title']
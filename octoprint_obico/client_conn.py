@@ -1,26 +1,32 @@
-import bson
 import logging
-import json
 import socket
 import threading
 import time
-import sys
-import zlib
 import re
-from collections import deque
 
-__python_version__ = 3 if sys.version_info >= (3, 0) else 2
+from .lib.datachannel_fragments import Fragmenter, MAX_DATAGRAM_SIZE, MAX_FRAGMENTS
+from .lib.serializer import OutboundMessage
+from .lib.rpc_dedupe import RpcDedupeStore, RPC_DONE, RPC_IN_FLIGHT
+from .lib.rpc_dispatcher import RpcDispatcher
 
 _logger = logging.getLogger('octoprint.plugins.obico')
-MAX_PAYLOAD_SIZE = 1500 # 1500 bytes is the max size of a UDP packet
+
+# The data channel is shared by every client watching the printer, so its messages stay plain zlib-compressed JSON that
+# any client can read. A client that can reassemble fragments has to renew that within this time. Fragments only replace
+# messages that would be dropped otherwise, so a client that can't reassemble them, watching at the same time, loses
+# nothing it used to get.
+FRAGMENTATION_NEGOTIATION_TTL_SECONDS = 120
 
 class ClientConn:
 
     def __init__(self, plugin):
         self.plugin = plugin
         self.printer_data_channel_conn = None
-        self.seen_refs = deque(maxlen=25)  # contains "last" 25 passthru refs
-        self.seen_refs_lock = threading.RLock()
+        self.rpc_results = RpcDedupeStore()
+        self.rpc_dispatcher = RpcDispatcher(on_error=lambda: self.plugin.sentry.captureException())
+        self._mutex = threading.RLock()
+        self.fragmentation_negotiated_ts = 0
+        self.compression_stats = dict(messages=0, bytes_in=0, bytes_out=0)
 
     def open_data_channel(self, janus_server, port):
         self.printer_data_channel_conn = DataChannelConn(janus_server, port)
@@ -33,58 +39,102 @@ class ClientConn:
             return
 
         ack_ref = msg.get('ref')
-        if ack_ref is not None:
-            # same msg may arrive through both ws and datachannel
-            with self.seen_refs_lock:
-                if ack_ref in self.seen_refs:
-                    _logger.debug('Got duplicate ref, ignoring msg')
-                    return
-                # no need to remove item or check fullness
-                # as deque manages that when maxlen is set
-                self.seen_refs.append(ack_ref)
-
-        error = None
-        try:
-            ret = func(*(self.extract_args(msg)), **(self.extract_kwargs(msg)))
-        except Exception as e:
-            error = str(e)
-            self.plugin.sentry.captureException()
-
         if ack_ref:
-
-            if error:
-                resp = {'ref': ack_ref, 'error': error}
-            else:
-                resp = {'ref': ack_ref, 'ret': ret}
-
-            self.plugin.send_ws_msg_to_server({'passthru': resp})
-            self.send_msg_to_client(resp)
-
-        self.plugin.boost_status_update()
+            # same msg may be retried by a client whose reply got lost. Duplicates are answered without executing the call again.
+            # One that arrives while the call executes gets the call's own reply, as replies always take the same paths. Unless
+            # that reply was a timeout error: then it gets the call's result when the call finishes.
+            (state, message) = self.rpc_results.begin(ack_ref, self.reply)
+            if state == RPC_DONE:
+                _logger.debug('Got duplicate ref, replying with cached result')
+                self.reply(message)
+                return
+            if state == RPC_IN_FLIGHT:
+                _logger.debug('Got duplicate ref while executing, reply when done')
+                return
+
+        replied_with_error = [False]
+
+        def call():
+            try:
+                resp = {'ref': ack_ref, 'ret': func(*(self.extract_args(msg)), **(self.extract_kwargs(msg)))}
+            except Exception as e:
+                self.plugin.sentry.captureException()
+                resp = {'ref': ack_ref, 'error': str(e)}
+
+            if not ack_ref:
+                return (None, None)
+
+            # Cached here rather than in on_result, so that the dispatcher's own errors (timeout, too many calls pending)
+            # are never cached. A call that timed out still caches its result when it finishes, for the client's retries.
+            message = OutboundMessage(resp)
+            self.rpc_results.complete(ack_ref, message, notify_waiters=replied_with_error[0])
+            return (message, None)
+
+        def on_result(message, error):
+            try:
+                if ack_ref:
+                    replied_with_error[0] = bool(error)
+                    self.reply(message if not error else OutboundMessage({'ref': ack_ref, 'error': error}))
+
+                self.plugin.boost_status_update()
+            except Exception:
+                self.plugin.sentry.captureException()
+
+        def on_skipped():
+            if ack_ref:
+                self.rpc_results.abandon(ack_ref)  # Never executed. A retry executes it.
+
+        # Doesn't block: the call runs in the dispatcher's threads
+        self.rpc_dispatcher.dispatch(msg.get('target'), msg['func'], call, on_result, on_skipped=on_skipped)
+
+    def reply(self, message):
+        # Serialized once for both paths. The server gets it wrapped in {'passthru': ...}
+        self.plugin.send_ws_msg_to_server(message.wrap('passthru'))
+        self.send_msg_to_client(message)
+
+    def rpc_stats(self):
+        return dict(self.rpc_results.stats(), dispatcher=self.rpc_dispatcher.stats())
 
     def send_msg_to_client(self, data):
         if self.printer_data_channel_conn is None:
             return
 
-        payload = json.dumps(data, default=str).encode('utf8')
-        if __python_version__ == 3:
-            compressor  = zlib.compressobj(
-                level=zlib.Z_DEFAULT_COMPRESSION, method=zlib.DEFLATED,
-                wbits=15, memLevel=8, strategy=zlib.Z_DEFAULT_STRATEGY)
-        else:
-            # no kw args
-            compressor  = zlib.compressobj(
-                zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 15, 8, zlib.Z_DEFAULT_STRATEGY)
+        message = data if isinstance(data, OutboundMessage) else OutboundMessage(data)
+        compressed_data = message.compressed()
 
-        compressed_data = compressor.compress(payload)
-        compressed_data += compressor.flush()
+        with self._mutex:
+            self.compression_stats['messages'] += 1
+            self.compression_stats['bytes_in'] += len(message.json())
+            self.compression_stats['bytes_out'] += len(compressed_data)
 
-        self.printer_data_channel_conn.send(compressed_data)
+        self.printer_data_channel_conn.send(compressed_data, fragments_allowed=self.data_channel_fragmentation_enabled())
+
+    def enable_data_channel_fragmentation(self):
+        '''
+        Called by clients (passthru target "client_conn") that can reassemble fragmented data channel messages, following
+        the rules in lib/datachannel_fragments.py.
+        '''
+        with self._mutex:
+            self.fragmentation_negotiated_ts = time.time()
+        return dict(max_datagram_size=MAX_DATAGRAM_SIZE, max_fragments=MAX_FRAGMENTS)
+
+    def data_channel_fragmentation_enabled(self):
+        with self._mutex:
+            return time.time() - self.fragmentation_negotiated_ts <= FRAGMENTATION_NEGOTIATION_TTL_SECONDS
 
     def close(self):
         if self.printer_data_channel_conn:
             self.printer_data_channel_conn.close()
 
+    def data_channel_stats(self):
+        conn = self.printer_data_channel_conn
+        if not conn:
+            return None
+
+        with self._mutex:
+            compression = dict(self.compression_stats)
+        return dict(conn.stats(), compression=compression, fragmentation_enabled=self.data_channel_fragmentation_enabled())
+
     def extract_args(self, msg):
         args = msg.get("args", [])
         if 'jog' == msg['func']:
@@ -116,9 +166,12 @@ class DataChannelConn(object):
         self.port = port
         self.sock = None
         self.sock_lock = threading.RLock()
+        self.fragmenter = Fragmenter()
 
-    def send(self, payload):
-        if len(payload) > MAX_PAYLOAD_SIZE:
+    def send(self, payload, fragments_allowed=False):
+        # Payloads above 1500 bytes (the max size of a UDP packet) are sent as several fragments, or dropped
+        datagrams = self.fragmenter.split(payload, fragments_allowed)
+        if not datagrams:
             _logger.debug('datachannel payload too big (%s)' % (len(payload), ))
             return
 
@@ -131,7 +184,8 @@ class DataChannelConn(object):
 
             if self.sock is not None:
                 try:
-                    self.sock.sendto(payload, (self.addr, self.port))
+                    for datagram in datagrams:
+                        self.sock.sendto(datagram, (self.addr, self.port))
                 except socket.error as ex:
                     _logger.error(
                         'could not send to janus datachannel (%s)' % ex)
@@ -139,6 +193,9 @@ class DataChannelConn(object):
                     _logger.error('udp socket might be closed (%s)' % ex)
                     self.sock = None
 
+    def stats(self):
+        return self.fragmenter.stats()
+
     def close(self):
         with self.sock_lock:
             self.sock.close()
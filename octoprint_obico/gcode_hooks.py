@@ -5,15 +5,22 @@ import time
 import octoprint
 
 from .utils import run_in_thread
+from .lib.gcode_matcher import GcodeLineMatcher, SKIPPED_PREFIXES, patterns_from_settings
 
 _logger = logging.getLogger('octoprint.plugins.obico')
 
+FAN_SPEED_RE = re.compile(r'\bS(\d+(\.\d+)?)', re.IGNORECASE)
+
 class GCodeHooks:
 
     def __init__(self, plugin, _print_job_tracker):
         self.plugin = plugin
         self._print_job_tracker = _print_job_tracker
         self.terminal_feed_is_on = False
+        self.line_matcher = GcodeLineMatcher()
+
+    def configure_line_patterns(self, extra_patterns):
+        self.line_matcher = GcodeLineMatcher(patterns_from_settings(extra_patterns))
 
     def queuing_gcode(self, comm_instance, phase, cmd, cmd_type, gcode, subcode=None, tags=None, *args, **kwargs):
         self.plugin.pause_resume_sequence.track_gcode(comm_instance, phase, cmd, cmd_type, gcode, subcode=None, tags=None, *args, **kwargs)
@@ -36,14 +43,12 @@ class GCodeHooks:
             return [] # remove layer indicator
 
     def received_gcode(self, comm, line, *args, **kwargs):
-
-        # credit: https://github.com/QuinnDamerell/OctoPrint-OctoEverywhere/blob/ef37e6c9ce6798e8af54a5fd81215d430c05bfad/octoprint_octoeverywhere/__init__.py#L272
-        lineLower = line.lower()
-        if "m600" in lineLower or ("fsensor_update" in lineLower and "m600" in lineLower) \
-            or "paused for user" in lineLower or "// action:paused" in lineLower:
+        # Runs on OctoPrint's serial reading thread for every line, most of them "ok" and temperatures. Keep it cheap:
+        # the prefix check is inlined, as a method call costs about as much as lower() and the substring tests.
+        if line[:2] not in SKIPPED_PREFIXES and self.line_matcher.match(line) in ('filament_runout', 'paused'):
             run_in_thread(self.plugin.post_filament_change_event)
 
-        if line and lineLower not in ['wait']:
+        if line and not (len(line) == 4 and line.lower() == 'wait'):
             self.passthru_terminal_feed(line)
 
         return line
@@ -51,7 +56,13 @@ class GCodeHooks:
     def sent_gcode(self, comm_instance, phase, cmd, cmd_type, gcode, subcode=None, tags=None, *args, **kwargs):
         if gcode == "M117":
             self.plugin.display_status = cmd[5:].strip()
+            self._print_job_tracker.mark_dirty()
             run_in_thread(self.plugin.post_update_to_server)
+        elif gcode == "M106":
+            m = FAN_SPEED_RE.search(cmd)
+            self._print_job_tracker.set_fan_speed(float(m.group(1)) / 255 * 100 if m else 100.0)
+        elif gcode == "M107":
+            self._print_job_tracker.set_fan_speed(0.0)
 
         if cmd:
             self.passthru_terminal_feed(cmd)
@@ -5,7 +5,6 @@ import time
 
 from threading import Thread
 import backoff
-import json
 import socket
 import psutil
 from octoprint.util import to_unicode
@@ -18,9 +17,11 @@ except ImportError:
 from .utils import ExpoBackoff, pi_version, is_port_open, wait_for_port, wait_for_port_to_close, run_in_thread
 from .ws import WebSocketClient
 from .lib import alert_queue
+from .lib.debug_log import SampledDebugLogger
 from .janus_config_builder import RUNTIME_JANUS_ETC_DIR
 
 _logger = logging.getLogger('octoprint.plugins.obico')
+_hot_path_logger = SampledDebugLogger(_logger)
 
 JANUS_WS_PORT = 17730   # Janus needs to use 17730 up to 17750. Hard-coded for now. may need to make it dynamic if the problem of port conflict is too much
 
@@ -122,9 +123,7 @@ class JanusConn:
 
     def process_janus_msg(self, ws, raw_msg):
         try:
-            msg = json.loads(raw_msg)
-            _logger.debug('Relaying Janus msg')
-            _logger.debug(msg)
+            _hot_path_logger.debug('Relaying Janus msg: %s', raw_msg)
             self.plugin.send_ws_msg_to_server(dict(janus=raw_msg))
         except:
             self.plugin.sentry.captureException()
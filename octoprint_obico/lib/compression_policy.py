@@ -0,0 +1,126 @@
+import re
+import time
+import zlib
+import threading
+
+LEVEL_FAST = 1
+LEVEL_HIGH = 9
+
+COMPRESS_THRESHOLD = 1000
+LEARN_MIN_SAMPLES = 5   # Responses under a path prefix before deciding whether it is incompressible
+INCOMPRESSIBLE_RATIO = 0.9  # compressed/original size at or above which compression is not worth the CPU
+REPROBE_EVERY = 100     # Compress every Nth response under an incompressible prefix anyway, in case its content changes
+
+# requests (urllib3) decodes these before we get the body. Any other encoding means the body is already compressed.
+ENCODINGS_DECODED_BY_REQUESTS = ('', 'identity', 'gzip', 'x-gzip', 'deflate')
+
+INCOMPRESSIBLE_CONTENT_TYPE_RE = re.compile(r'^(image/(png|jpeg|gif|webp)|video/|audio/|font/woff|application/(zip|gzip|x-gzip|x-7z-compressed|x-bzip2|font-woff))')
+HIGH_LEVEL_CONTENT_TYPE_RE = re.compile(r'^(text/(css|html|javascript)|application/(javascript|x-javascript)|image/svg\+xml)')
+
+MAGIC_NUMBERS = (
+    b'\x89PNG',
+    b'\xff\xd8\xff',    # jpeg
+    b'GIF8',
+    b'RIFF',    # webp, avi, wav
+    b'\x1f\x8b',    # gzip
+    b'PK\x03\x04',  # zip
+    b'BZh',
+    b'7z\xbc\xaf',
+    b'wOFF',
+    b'wOF2',
+)
+
+_thread_time = getattr(time, 'thread_time', time.time)
+
+
+class CompressionPolicy:
+    '''
+    Decides how (and if) to compress a tunnelled response, based on its Content-Type/Content-Encoding, its first bytes,
+    and what has been learned about past responses under the same path prefix. Keeps per-category statistics.
+    All methods are thread-safe.
+    '''
+
+    def __init__(self, threshold=COMPRESS_THRESHOLD):
+        self._mutex = threading.RLock()
+        self.threshold = threshold
+        self.prefixes = dict()     # path prefix -> dict(samples, bytes_in, bytes_out, incompressible, skipped)
+        self.categories = dict()   # category -> dict(count, bytes_in, bytes_out, cpu_seconds)
+
+    def choose(self, path, headers, head):
+        '''
+        Return (level, category). level is None when the body should be sent uncompressed.
+        head is the beginning of the body (the whole body when it is not streamed).
+        '''
+        encoding = (headers.get('Content-Encoding') or '').strip().lower()
+        if encoding not in ENCODINGS_DECODED_BY_REQUESTS:
+            return (None, 'skip_encoding')
+
+        content_type = (headers.get('Content-Type') or '').strip().lower()
+        if INCOMPRESSIBLE_CONTENT_TYPE_RE.match(content_type):
+            return (None, 'skip_content_type')
+
+        if head[:4].startswith(MAGIC_NUMBERS) or head[4:8] == b'ftyp':     # ftyp: mp4/mov
+            return (None, 'skip_magic')
+
+        with self._mutex:
+            prefix = self.prefixes.get(path_prefix(path))
+            if prefix and prefix['incompressible']:
+                prefix['skipped'] += 1
+                if prefix['skipped'] % REPROBE_EVERY != 0:
+                    return (None, 'skip_learned')
+
+        if HIGH_LEVEL_CONTENT_TYPE_RE.match(content_type):
+            return (LEVEL_HIGH, 'high')
+        return (LEVEL_FAST, 'fast')
+
+    def compress(self, path, headers, content):
+        '''
+        Return (compressed, content) for a fully read body.
+        '''
+        if len(content) < self.threshold:
+            return (False, content)
+
+        (level, category) = self.choose(path, headers, content[:16])
+        if level is None:
+            self.record(category, len(content), len(content), 0)
+            return (False, content)
+
+        started = _thread_time()
+        compressed = zlib.compress(content, level)
+        self.record(category, len(content), len(compressed), _thread_time() - started)
+        self.learn(path, len(content), len(compressed))
+        return (True, compressed)
+
+    def learn(self, path, bytes_in, bytes_out):
+        with self._mutex:
+            prefix = self.prefixes.setdefault(path_prefix(path), dict(samples=0, bytes_in=0, bytes_out=0, incompressible=False, skipped=0))
+            prefix['samples'] += 1
+            prefix['bytes_in'] += bytes_in
+            prefix['bytes_out'] += bytes_out
+            if prefix['samples'] >= LEARN_MIN_SAMPLES:
+                prefix['incompressible'] = prefix['bytes_out'] >= prefix['bytes_in'] * INCOMPRESSIBLE_RATIO
+                prefix['samples'] = prefix['bytes_in'] = prefix['bytes_out'] = 0  # Start over so that the verdict follows the content
+
+    def record(self, category, bytes_in, bytes_out, cpu_seconds):
+        with self._mutex:
+            stat = self.categories.setdefault(category, dict(count=0, bytes_in=0, bytes_out=0, cpu_seconds=0.0))
+            stat['count'] += 1
+            stat['bytes_in'] += bytes_in
+            stat['bytes_out'] += bytes_out
+            stat['cpu_seconds'] += cpu_seconds
+
+    def stats(self):
+        with self._mutex:
+            categories = dict()
+            for (category, stat) in self.categories.items():
+                categories[category] = dict(stat, ratio=(float(stat['bytes_out']) / stat['bytes_in']) if stat['bytes_in'] else None)
+            return dict(
+                categories=categories,
+                incompressible_prefixes=[p for (p, v) in self.prefixes.items() if v['incompressible']],
+            )
+
+
+def path_prefix(path):
+    # '/downloads/timelapse/foo.mp4?x=1' -> '/downloads/timelapse'
+    segments = (path or '').split('?', 1)[0].split('/')
+    return '/'.join(segments[:3])
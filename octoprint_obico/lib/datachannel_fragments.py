@@ -0,0 +1,70 @@
+import struct
+import itertools
+import threading
+
+# A data channel message is one UDP datagram to Janus. Messages above this size are split into fragments.
+MAX_DATAGRAM_SIZE = 1500
+
+# A message that fits in one datagram is sent as is. zlib streams start with 0x78, so it can't be confused with a fragment.
+# Messages are only fragmented while a client that can reassemble them is watching (see ClientConn), and dropped
+# otherwise. A fragment is:
+#   FRAGMENT_MAGIC (1 byte) | message id (uint16) | fragment index (uint16) | fragment count (uint16) | piece of the message
+# all big-endian. The pieces of a message, in index order, concatenate to the message.
+FRAGMENT_MAGIC = 0xfe
+FRAGMENT_HEADER = struct.Struct('>BHHH')
+FRAGMENT_PAYLOAD_SIZE = MAX_DATAGRAM_SIZE - FRAGMENT_HEADER.size
+MAX_FRAGMENTS = 64      # About 95KB. Bigger messages are dropped rather than flooding the data channel.
+
+# Reassembly rules, which clients must follow:
+#   - fragments of a message may arrive in any order, duplicates are ignored;
+#   - a message is delivered as soon as all its `count` fragments have arrived;
+#   - a message that is not complete REASSEMBLY_TIMEOUT_SECONDS after its first fragment arrived is dropped;
+#   - at most MAX_PENDING_MESSAGES messages are reassembled at once. The oldest is dropped to make room for a new one;
+#   - a fragment whose count differs from the other fragments of the same message id drops that message.
+REASSEMBLY_TIMEOUT_SECONDS = 2.0
+MAX_PENDING_MESSAGES = 8
+
+
+class Fragmenter(object):
+    '''
+    Splits a data channel message into datagrams. Thread-safe.
+    '''
+
+    def __init__(self):
+        self._mutex = threading.RLock()
+        self.msg_ids = itertools.count()
+        self.messages = 0
+        self.fragmented = 0
+        self.fragments = 0
+        self.dropped = 0
+
+    def split(self, payload, fragments_allowed=True):
+        '''
+        Return the list of datagrams to send. Empty if the message is too big: for one datagram when fragments_allowed
+        is False, or even when fragmented.
+        '''
+        if len(payload) <= MAX_DATAGRAM_SIZE:
+            with self._mutex:
+                self.messages += 1
+            return [payload]
+
+        count = (len(payload) + FRAGMENT_PAYLOAD_SIZE - 1) // FRAGMENT_PAYLOAD_SIZE
+        with self._mutex:
+            if not fragments_allowed or count > MAX_FRAGMENTS:
+                self.dropped += 1
+                return []
+
+            msg_id = next(self.msg_ids) % 0x10000
+            self.messages += 1
+            self.fragmented += 1
+            self.fragments += count
+
+        return [
+            FRAGMENT_HEADER.pack(FRAGMENT_MAGIC, msg_id, index, count) + payload[index * FRAGMENT_PAYLOAD_SIZE:(index + 1) * FRAGMENT_PAYLOAD_SIZE]
+            for index in range(count)
+        ]
+
+    def stats(self):
+        with self._mutex:
+            return dict(messages=self.messages, fragmented=self.fragmented, fragments=self.fragments, dropped=self.dropped)
+
@@ -0,0 +1,42 @@
+# coding=utf-8
+
+### Debug logging for hot paths (messages to/from the server, Janus relay, tunnel).
+#   Nothing is formatted unless debug logging is enabled, and in sampled mode only 1 in N messages per call site is logged.
+
+import logging
+import threading
+
+_sample_every = 1
+
+
+def set_sample_rate(sample_every):
+    global _sample_every
+    _sample_every = max(1, int(sample_every or 1))
+
+
+class SampledDebugLogger:
+    '''
+    A call site is told apart by its format string, so call sites sharing a logger are sampled independently.
+    '''
+
+    def __init__(self, logger):
+        self._mutex = threading.RLock()
+        self.logger = logger
+        self.counts = {}    # format string -> messages seen
+
+    def enabled(self):
+        return self.logger.isEnabledFor(logging.DEBUG)
+
+    def debug(self, msg, *args):
+        # Arguments are %-formatted by logging, i.e. only when the record is actually emitted
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+
+        if _sample_every > 1:
+            with self._mutex:
+                count = self.counts[msg] = self.counts.get(msg, 0) + 1
+                if count % _sample_every != 1:
+                    return
+
+        self.logger.debug(msg, *args)
+
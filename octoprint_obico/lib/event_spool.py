@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import logging
+import threading
+
+_logger = logging.getLogger('octoprint.plugins.obico')
+
+MAX_SPOOL_BYTES = 1024 * 1024
+FSYNC_BATCH_SIZE = 10   # fsync after this many appends...
+FSYNC_INTERVAL_SECONDS = 5.0    # ... or when the oldest un-synced append is this old, whichever comes first
+
+
+class EventSpool:
+    '''
+    Append-only on-disk spool for messages that must survive a server outage (such as print events).
+    One JSON document per line, so that a torn write at the end of the file loses at most the last entry.
+    All methods are thread-safe.
+    '''
+
+    def __init__(self, path, max_bytes=MAX_SPOOL_BYTES, fsync_batch_size=FSYNC_BATCH_SIZE, fsync_interval=FSYNC_INTERVAL_SECONDS):
+        self._mutex = threading.RLock()
+        self.path = path
+        self.max_bytes = max_bytes
+        self.fsync_batch_size = fsync_batch_size
+        self.fsync_interval = fsync_interval
+        self._fp = None
+        self._unsynced = 0
+        self._first_unsynced_ts = None
+
+    def append(self, data):
+        line = json.dumps(data, default=str).encode('utf8') + b'\n'
+        with self._mutex:
+            if len(line) > self.max_bytes:
+                _logger.warning('Event too big for the spool ({} bytes), dropped'.format(len(line)))
+                return
+
+            if self.size() + len(line) > self.max_bytes:
+                self._truncate_oldest(len(line))
+
+            fp = self._open()
+            fp.write(line)
+            fp.flush()
+
+            self._unsynced += 1
+            if self._first_unsynced_ts is None:
+                self._first_unsynced_ts = time.time()
+            if self._unsynced >= self.fsync_batch_size:
+                self.sync()
+
+    def sync(self, force=False):
+        with self._mutex:
+            if not self._unsynced:
+                return
+            if not force and self._unsynced < self.fsync_batch_size and time.time() - self._first_unsynced_ts < self.fsync_interval:
+                return
+            try:
+                os.fsync(self._fp.fileno())
+            except (OSError, ValueError) as e:
+                _logger.warning('Failed to fsync event spool - {}'.format(e))
+            self._unsynced = 0
+            self._first_unsynced_ts = None
+
+    def drain(self):
+        '''
+        Return all spooled messages, oldest first, and empty the spool.
+        '''
+        with self._mutex:
+            entries = self._read_all()
+            self._close()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            return entries
+
+    def restore(self, entries):
+        '''
+        Put back entries returned by drain() but not delivered, in front of anything spooled since.
+        '''
+        with self._mutex:
+            self._rewrite([json.dumps(e, default=str).encode('utf8') + b'\n' for e in entries + self._read_all()])
+
+    def is_empty(self):
+        return self.size() == 0
+
+    def size(self):
+        with self._mutex:
+            try:
+                return os.path.getsize(self.path)
+            except OSError:
+                return 0
+
+    def close(self):
+        with self._mutex:
+            self.sync(force=True)
+            self._close()
+
+    def _open(self):
+        if self._fp is None:
+            self._fp = open(self.path, 'ab')
+        return self._fp
+
+    def _close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+        self._unsynced = 0
+        self._first_unsynced_ts = None
+
+    def _read_all(self):
+        if self._fp is not None:
+            self._fp.flush()
+
+        entries = []
+        try:
+            with open(self.path, 'rb') as fp:
+                for line in fp:
+                    try:
+                        entries.append(json.loads(line.decode('utf8')))
+                    except ValueError:
+                        _logger.warning('Skipped a corrupted entry in event spool')
+        except (IOError, OSError):
+            pass
+        return entries
+
+    def _truncate_oldest(self, room_needed):
+        # Drop the oldest entries until the new one fits. Rewritten through a temp file so a crash never leaves a partial spool.
+        entries = self._read_all()
+        lines = [json.dumps(e, default=str).encode('utf8') + b'\n' for e in entries]
+        total = sum(len(l) for l in lines)
+        dropped = 0
+        while lines and total + room_needed > self.max_bytes:
+            total -= len(lines.pop(0))
+            dropped += 1
+        _logger.warning('Event spool is full. Dropped {} oldest event(s)'.format(dropped))
+        self._rewrite(lines)
+
+    def _rewrite(self, lines):
+        self._close()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as fp:
+            fp.writelines(lines)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmp_path, self.path)
+
+
+def is_event_msg(data):
+    return isinstance(data, dict) and 'event' in data
@@ -0,0 +1,65 @@
+import threading
+import bisect
+from collections import deque
+
+# Upper bounds, in seconds, of the histogram buckets. The last bucket catches everything above.
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class MovingHistogram:
+    '''
+    Keeps the last `maxlen` samples (e.g. round-trip times in seconds) and summarizes them as
+    bucket counts and percentiles. All methods are thread-safe.
+    '''
+
+    def __init__(self, maxlen=200, buckets=DEFAULT_BUCKETS):
+        self._mutex = threading.RLock()
+        self.samples = deque(maxlen=maxlen)
+        self.buckets = buckets
+        self.total_count = 0
+
+    def add(self, value):
+        with self._mutex:
+            self.samples.append(value)
+            self.total_count += 1
+
+    def last(self):
+        with self._mutex:
+            return self.samples[-1] if self.samples else None
+
+    def percentile(self, pct):
+        with self._mutex:
+            return self._percentile(sorted(self.samples), pct)
+
+    def as_dict(self):
+        with self._mutex:
+            samples = list(self.samples)
+            total_count = self.total_count
+
+        if not samples:
+            return dict(count=0, total_count=total_count)
+
+        ordered = sorted(samples)
+        counts = [0] * (len(self.buckets) + 1)
+        for v in samples:
+            counts[bisect.bisect_left(self.buckets, v)] += 1
+
+        return dict(
+            count=len(samples),
+            total_count=total_count,
+            last=samples[-1],
+            min=ordered[0],
+            max=ordered[-1],
+            avg=sum(ordered) / len(ordered),
+            p50=self._percentile(ordered, 50),
+            p95=self._percentile(ordered, 95),
+            p99=self._percentile(ordered, 99),
+            buckets=[dict(le=le, count=c) for (le, c) in zip(list(self.buckets) + ['+Inf'], counts)],
+        )
+
+    @staticmethod
+    def _percentile(ordered, pct):
+        if not ordered:
+            return None
+        idx = int(round((len(ordered) - 1) * pct / 100.0))
+        return ordered[idx]
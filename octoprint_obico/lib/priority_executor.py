@@ -0,0 +1,78 @@
+import time
+import logging
+import threading
+import itertools
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .moving_histogram import MovingHistogram
+
+_logger = logging.getLogger('octoprint.plugins.obico')
+
+
+class PriorityExecutor:
+    '''
+    A fixed number of daemon worker threads fed by a bounded priority queue. Lower priority values run first,
+    and tasks of the same priority run in submission order. Queue time and service time of tasks are tracked.
+    '''
+
+    def __init__(self, name, workers, max_queue_size, on_error=None):
+        self._mutex = threading.RLock()
+        self.name = name
+        self.on_error = on_error
+        self.task_queue = queue.PriorityQueue(maxsize=max_queue_size)
+        self.seq = itertools.count()
+        self.queue_time = MovingHistogram()
+        self.service_time = MovingHistogram()
+        self.rejected = 0
+        self.busy = 0
+        self.workers = workers
+
+        for i in range(workers):
+            worker_thread = threading.Thread(target=self.worker_loop, name='obico-{}-{}'.format(name, i))
+            worker_thread.daemon = True
+            worker_thread.start()
+
+    def submit(self, func, priority=0, *args, **kwargs):
+        '''
+        Return False, without running func, if the queue is full.
+        '''
+        try:
+            self.task_queue.put_nowait((priority, next(self.seq), time.time(), func, args, kwargs))
+            return True
+        except queue.Full:
+            with self._mutex:
+                self.rejected += 1
+            return False
+
+    def worker_loop(self):
+        while True:
+            (_, _, enqueued_ts, func, args, kwargs) = self.task_queue.get()
+            started_ts = time.time()
+            self.queue_time.add(started_ts - enqueued_ts)
+            with self._mutex:
+                self.busy += 1
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                if self.on_error:
+                    self.on_error()
+                else:
+                    _logger.exception('Task failed in {} executor'.format(self.name))
+            finally:
+                with self._mutex:
+                    self.busy -= 1
+                self.service_time.add(time.time() - started_ts)
+
+    def stats(self):
+        with self._mutex:
+            return dict(
+                workers=self.workers,
+                busy=self.busy,
+                queued=self.task_queue.qsize(),
+                rejected=self.rejected,
+                queue_time=self.queue_time.as_dict(),
+                service_time=self.service_time.as_dict(),
+            )
@@ -0,0 +1,150 @@
+import re
+import json
+import time
+import logging
+import threading
+from logging.handlers import RotatingFileHandler
+
+from .moving_histogram import MovingHistogram
+
+TRACE_FILE_MAX_BYTES = 5 * 1024 * 1024
+TRACE_FILE_BACKUP_COUNT = 1
+
+# Serialized message sizes, in bytes
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# Phases of a tunnelled request, in seconds:
+#   queued:   waiting for a tunnel worker
+#   fetch:    request to OctoPrint, until the body is read
+#   compress: CPU time spent compressing the body
+#   outbound: waiting in the message queue to the server, until the websocket send returns
+#   total:    from enqueue to the (last) response message being sent to the server
+PHASES = ('queued', 'fetch', 'compress', 'outbound', 'total')
+
+STATIC_PATH_RE = re.compile(r'^/(static|plugin/[^/]+/static)/')
+
+
+def path_class(path):
+    path = (path or '').split('?', 1)[0]
+    if STATIC_PATH_RE.match(path):
+        return 'static'
+    if path.startswith('/downloads/'):
+        return 'download'
+    if path.startswith('/api/') or path.startswith('/plugin/'):
+        return 'api'
+    return 'other'
+
+
+class RequestTrace(object):
+    '''
+    Timings of one tunnelled request. Not thread-safe by itself: the phases of a request happen one after another.
+    '''
+
+    def __init__(self, tracer, ref, method, path):
+        self.tracer = tracer
+        self.ref = ref
+        self.method = method
+        self.path = path
+        self.enqueued_ts = time.time()
+        self.started_ts = None
+        self.fetch = None
+        self.compress = 0.0
+        self.outbound = 0.0
+        self.size = 0
+        self.status = None
+        self.cached = False
+        self.finished = False
+
+    def start(self):
+        self.started_ts = time.time()
+
+    def fetched(self, status):
+        self.status = status
+        if self.started_ts is not None:
+            self.fetch = time.time() - self.started_ts
+
+    def add_compress(self, cpu_seconds):
+        self.compress += cpu_seconds
+
+    def sent(self, size, outbound_seconds):
+        # For streamed responses, called for each chunk. Sizes add up, the outbound wait of the worst chunk is kept.
+        self.size += size
+        self.outbound = max(self.outbound, outbound_seconds)
+
+    def sent_last(self, size, outbound_seconds):
+        self.sent(size, outbound_seconds)
+        self.finish()
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        self.tracer.record(self)
+
+    def as_dict(self):
+        return dict(
+            ts=self.enqueued_ts,
+            ref=self.ref,
+            method=self.method,
+            path=self.path,
+            path_class=path_class(self.path),
+            status=self.status,
+            cached=self.cached,
+            size=self.size,
+            queued=(self.started_ts - self.enqueued_ts) if self.started_ts is not None else None,
+            fetch=self.fetch,
+            compress=self.compress,
+            outbound=self.outbound,
+            total=time.time() - self.enqueued_ts,
+        )
+
+
+class RequestTracer(object):
+    '''
+    Keeps rolling latency histograms of tunnelled requests per path class (api, static, download, other), and optionally
+    writes one JSON line per request to a (rotated) trace file. All methods are thread-safe.
+    '''
+
+    def __init__(self, trace_path=None):
+        self._mutex = threading.RLock()
+        self.classes = dict()
+        self.trace_logger = None
+        if trace_path:
+            self.trace_logger = logging.getLogger('octoprint.plugins.obico.tunnel_trace')
+            self.trace_logger.propagate = False
+            self.trace_logger.setLevel(logging.INFO)
+            if not self.trace_logger.handlers:
+                handler = RotatingFileHandler(trace_path, maxBytes=TRACE_FILE_MAX_BYTES, backupCount=TRACE_FILE_BACKUP_COUNT)
+                handler.setFormatter(logging.Formatter('%(message)s'))
+                self.trace_logger.addHandler(handler)
+
+    def start(self, ref, method, path):
+        return RequestTrace(self, ref, method, path)
+
+    def record(self, trace):
+        trace_dict = trace.as_dict()
+        with self._mutex:
+            histograms = self.classes.get(trace_dict['path_class'])
+            if histograms is None:
+                histograms = dict((phase, MovingHistogram()) for phase in PHASES)
+                histograms['size'] = MovingHistogram(buckets=SIZE_BUCKETS)
+                histograms['cached'] = 0
+                self.classes[trace_dict['path_class']] = histograms
+
+            for phase in PHASES + ('size',):
+                if trace_dict[phase] is not None:
+                    histograms[phase].add(trace_dict[phase])
+            if trace.cached:
+                histograms['cached'] += 1
+
+        if self.trace_logger:
+            self.trace_logger.info(json.dumps(trace_dict))
+
+    def stats(self):
+        with self._mutex:
+            classes = list(self.classes.items())
+
+        results = dict()
+        for (cls, histograms) in classes:
+            results[cls] = dict((k, v.as_dict() if isinstance(v, MovingHistogram) else v) for (k, v) in histograms.items())
+        return results
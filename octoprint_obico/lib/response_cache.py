@@ -0,0 +1,128 @@
+import threading
+from collections import OrderedDict
+
+MAX_CACHE_BYTES = 16 * 1024 * 1024
+
+# Request headers that may change the response of a static asset, and hence are part of the cache key
+VARY_HEADERS = ('accept-encoding', 'accept-language')
+
+# Response headers that prevent caching
+UNCACHEABLE_CACHE_CONTROL = ('no-store', 'private')
+
+# Request headers that turn a miss into a 304 from OctoPrint, which can't be cached. They are not forwarded on a miss:
+# the 200 is cached, and the browser gets its 304 from the plugin instead.
+CONDITIONAL_HEADERS = ('if-none-match', 'if-modified-since')
+
+
+class ResponseCache:
+    '''
+    LRU cache of tunnelled responses, bounded by the total size of their (already compressed) bodies.
+    Entries stored under a different version (e.g. OctoPrint or plugin version) are treated as misses.
+    All methods are thread-safe.
+    '''
+
+    def __init__(self, version=None, max_bytes=MAX_CACHE_BYTES):
+        self._mutex = threading.RLock()
+        self.version = version
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def get(self, key):
+        with self._mutex:
+            entry = self.entries.get(key)
+            if entry is None or entry['version'] != self.version:
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, status, compressed, content, headers, etag=None):
+        size = len(content)
+        if size > self.max_bytes / 4:  # Don't let one big response flush everything else
+            return
+
+        with self._mutex:
+            if key in self.entries:
+                self._remove(key)
+
+            self.entries[key] = dict(version=self.version, status=status, compressed=compressed, content=content, headers=headers, etag=etag, size=size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate(self, version=None):
+        with self._mutex:
+            self.entries.clear()
+            self.total_bytes = 0
+            if version is not None:
+                self.version = version
+
+    def count_not_modified(self):
+        with self._mutex:
+            self.not_modified += 1
+
+    def stats(self):
+        with self._mutex:
+            return dict(
+                entries=len(self.entries),
+                bytes=self.total_bytes,
+                hits=self.hits,
+                misses=self.misses,
+                not_modified=self.not_modified,
+            )
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry['size']
+
+
+def cache_key(method, path, params, headers):
+    lower_headers = dict((k.lower(), v) for (k, v) in (headers or {}).items())
+    return (
+        method.lower(),
+        path,
+        tuple(sorted((k, str(v)) for (k, v) in (params or {}).items())),
+        tuple(lower_headers.get(h) for h in VARY_HEADERS),
+    )
+
+
+def is_cacheable_response(status, headers):
+    if status != 200 or 'Set-Cookie' in headers:
+        return False
+    cache_control = (headers.get('Cache-Control') or '').lower()
+    return not any(directive in cache_control for directive in UNCACHEABLE_CACHE_CONTROL)
+
+
+def without_conditional_headers(headers):
+    return dict((k, v) for (k, v) in (headers or {}).items() if k.lower() not in CONDITIONAL_HEADERS)
+
+
+def is_not_modified(request_headers, response_headers):
+    '''
+    Whether the response is what the browser already has, according to the conditional headers of its request.
+    '''
+    request_headers = dict((k.lower(), v) for (k, v) in (request_headers or {}).items())
+    response_headers = dict((k.lower(), v) for (k, v) in (response_headers or {}).items())
+    if request_headers.get('if-none-match'):
+        return etag_matches(request_headers['if-none-match'], response_headers.get('etag'))
+    return bool(request_headers.get('if-modified-since')) and request_headers['if-modified-since'] == response_headers.get('last-modified')
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match or not etag:
+        return False
+
+    def strip_weak(tag):
+        tag = tag.strip()
+        return tag[2:] if tag.startswith('W/') else tag
+
+    candidates = [strip_weak(t) for t in if_none_match.split(',')]
+    return '*' in candidates or strip_weak(etag) in candidates
@@ -0,0 +1,94 @@
+import time
+import threading
+from collections import OrderedDict
+
+RESULT_TTL_SECONDS = 60
+MAX_RESULTS = 64    # Results can be big (e.g. list_files), so only the most recent ones are kept
+
+# What begin() tells the caller to do
+RPC_NEW = 'new'              # Execute the call, then complete() it
+RPC_IN_FLIGHT = 'in_flight'  # The same call is executing. The waiter, if any, will be called with its result
+RPC_DONE = 'done'            # The call has completed. Reply with the cached result
+
+
+class RpcDedupeStore(object):
+    '''
+    Makes passthru RPC calls idempotent by their ref: the same call may arrive more than once, e.g. through both the
+    server websocket and the data channel, or as a client retry. Completed results are kept in an LRU bounded by size
+    and age, so that a duplicate is answered without executing the call again. All methods are thread-safe.
+    '''
+
+    def __init__(self, ttl=RESULT_TTL_SECONDS, max_results=MAX_RESULTS):
+        self._mutex = threading.RLock()
+        self.ttl = ttl
+        self.max_results = max_results
+        self.results = OrderedDict()   # ref -> (completed_ts, result)
+        self.in_flight = dict()        # ref -> [waiter, ...]
+        self.executed = 0
+        self.answered_from_cache = 0
+        self.waited = 0
+
+    def begin(self, ref, waiter=None):
+        '''
+        Return (RPC_NEW, None), (RPC_IN_FLIGHT, None) or (RPC_DONE, result). waiter(result) is kept only for RPC_IN_FLIGHT.
+        '''
+        with self._mutex:
+            self.expire()
+
+            if ref in self.results and self.results[ref][0] < time.time() - self.ttl:   # Moved to the end by a hit, but too old
+                del self.results[ref]
+
+            if ref in self.results:
+                self.results.move_to_end(ref)
+                self.answered_from_cache += 1
+                return (RPC_DONE, self.results[ref][1])
+
+            if ref in self.in_flight:
+                if waiter:
+                    self.in_flight[ref].append(waiter)
+                self.waited += 1
+                return (RPC_IN_FLIGHT, None)
+
+            self.in_flight[ref] = []
+            self.executed += 1
+            return (RPC_NEW, None)
+
+    def complete(self, ref, result, notify_waiters=True):
+        '''
+        Cache the result and hand it to the duplicates that arrived while the call was executing. With notify_waiters
+        False, they are forgotten instead, e.g. when the reply to the call itself reaches them too.
+        '''
+        with self._mutex:
+            waiters = self.in_flight.pop(ref, [])
+            self.results[ref] = (time.time(), result)
+            self.results.move_to_end(ref)
+            while len(self.results) > self.max_results:
+                self.results.popitem(last=False)
+
+        for waiter in (waiters if notify_waiters else []):
+            waiter(result)
+
+    def abandon(self, ref):
+        '''
+        Forget a call that begin() returned RPC_NEW for but that will never complete, so that a retry executes it.
+        '''
+        with self._mutex:
+            self.in_flight.pop(ref, None)
+
+    def expire(self):
+        deadline = time.time() - self.ttl
+        while self.results:
+            (ref, (completed_ts, _)) = next(iter(self.results.items()))
+            if completed_ts >= deadline:
+                break
+            del self.results[ref]
+
+    def stats(self):
+        with self._mutex:
+            return dict(
+                executed=self.executed,
+                answered_from_cache=self.answered_from_cache,
+                waited=self.waited,
+                in_flight=len(self.in_flight),
+                cached=len(self.results),
+            )
@@ -0,0 +1,172 @@
+import time
+import heapq
+import logging
+import threading
+import itertools
+
+from .moving_histogram import MovingHistogram
+from .priority_executor import PriorityExecutor
+
+_logger = logging.getLogger('octoprint.plugins.obico')
+
+RPC_TIMEOUT_SECONDS = 30
+RPC_READ_ONLY_WORKERS = 3
+RPC_MAX_QUEUE_SIZE = 50
+
+# Calls that don't change anything. They run in parallel, so that e.g. a slow list_files doesn't hold up a pause.
+READ_ONLY_FUNCS = frozenset((
+    ('_file_manager', 'list_files'),
+    ('_file_manager', 'get_metadata'),
+    ('_file_manager', 'file_exists'),
+    ('_printer', 'get_current_data'),
+    ('_printer', 'get_current_job'),
+    ('_printer', 'get_current_temperatures'),
+    ('file_operations', 'check_filepath_and_agent_signature'),
+    ('timeseries', 'get_window'),
+))
+
+# Everything else runs one call at a time per lane, in arrival order. Calls that control the printer share one lane,
+# so that e.g. a print started through file_operations and a pause through _printer are never reordered.
+PRINTER_CONTROL_TARGETS = ('_printer', 'file_operations', 'file_downloader')
+READ_ONLY_LANE = 'read_only'
+PRINTER_CONTROL_LANE = 'printer'
+
+
+def lane_for(target, func):
+    if (target, func) in READ_ONLY_FUNCS:
+        return READ_ONLY_LANE
+    if target in PRINTER_CONTROL_TARGETS:
+        return PRINTER_CONTROL_LANE
+    return target
+
+
+class RpcDispatcher(object):
+    '''
+    Runs passthru RPC calls off the thread that receives them: read-only calls in a small pool, other calls serialized
+    per lane (see lane_for). Every call gets exactly one result: its own, or a timeout error if it takes more than
+    `timeout` seconds from its arrival. A call still waiting in its lane at that point is never executed, so that e.g. a
+    pause or a jog the client was told failed doesn't happen later. A call that times out while running keeps running,
+    but its result is not passed to on_result. Deadlines are watched by one thread shared by all calls. Latencies are
+    tracked per function.
+    '''
+
+    def __init__(self, read_only_workers=RPC_READ_ONLY_WORKERS, max_queue_size=RPC_MAX_QUEUE_SIZE, timeout=RPC_TIMEOUT_SECONDS, on_error=None):
+        self._mutex = threading.RLock()
+        self.max_queue_size = max_queue_size
+        self.timeout = timeout
+        self.on_error = on_error
+        self.lanes = {READ_ONLY_LANE: PriorityExecutor('rpc-' + READ_ONLY_LANE, read_only_workers, max_queue_size, on_error=on_error)}
+        self.latencies = dict()     # 'target.func' -> MovingHistogram
+        self.timed_out = 0
+        self.expired = 0
+        self.rejected = 0
+
+        self.deadlines = []     # heap of (deadline_ts, seq, on_timeout). Entries of finished calls stay until their deadline.
+        self.deadline_seq = itertools.count()
+        self.deadline_changed = threading.Condition(self._mutex)
+        self.watchdog = None
+
+    def dispatch(self, target, func, call, on_result, on_skipped=None):
+        '''
+        call() returns (ret, error). on_result(ret, error) is called exactly once, from a worker or the watchdog thread,
+        or right away when there are too many calls pending. When call will never run (too many calls pending, or timed
+        out before it started), on_skipped() is called first. Return False, without running call, if there are too many
+        calls pending.
+        '''
+        func_name = '{}.{}'.format(target, func)
+        arrived_ts = time.time()
+        state = dict(started=False, finished=False)
+
+        def finish(ret, error, skipped=False):
+            if skipped and on_skipped:
+                on_skipped()
+            on_result(ret, error)
+
+        def on_timeout():
+            with self._mutex:
+                if state['finished']:
+                    return
+                state['finished'] = True
+                skipped = not state['started']
+                if skipped:
+                    self.expired += 1
+                else:
+                    self.timed_out += 1
+
+            if skipped:
+                _logger.warning('Passthru call {} timed out before it started. Not executed'.format(func_name))
+                finish(None, 'Timed out after {} seconds waiting for other calls. Not executed'.format(self.timeout), skipped=True)
+            else:
+                _logger.warning('Passthru call {} timed out'.format(func_name))
+                finish(None, 'Timed out after {} seconds'.format(self.timeout))
+
+        def run():
+            with self._mutex:
+                if state['finished']:  # Timed out while waiting in the lane. The client was told it was not executed.
+                    return
+                state['started'] = True
+
+            (ret, error) = call()
+            self.latency_histogram(func_name).add(time.time() - arrived_ts)
+            with self._mutex:
+                if state['finished']:
+                    return
+                state['finished'] = True
+            finish(ret, error)
+
+        if not self.lane(lane_for(target, func)).submit(run):
+            with self._mutex:
+                self.rejected += 1
+                state['finished'] = True
+            finish(None, 'Too many passthru calls pending', skipped=True)
+            return False
+
+        self.watch(arrived_ts + self.timeout, on_timeout)
+        return True
+
+    def watch(self, deadline_ts, on_timeout):
+        with self._mutex:
+            if self.watchdog is None:
+                self.watchdog = threading.Thread(target=self.watchdog_loop, name='obico-rpc-watchdog')
+                self.watchdog.daemon = True
+                self.watchdog.start()
+
+            heapq.heappush(self.deadlines, (deadline_ts, next(self.deadline_seq), on_timeout))
+            self.deadline_changed.notify()
+
+    def watchdog_loop(self):
+        while True:
+            with self._mutex:
+                while not self.deadlines or self.deadlines[0][0] > time.time():
+                    self.deadline_changed.wait(self.deadlines[0][0] - time.time() if self.deadlines else None)
+                (_, _, on_timeout) = heapq.heappop(self.deadlines)
+
+            try:
+                on_timeout()
+            except Exception:
+                if self.on_error:
+                    self.on_error()
+                else:
+                    _logger.exception('Passthru call timeout handler failed')
+
+    def lane(self, name):
+        with self._mutex:
+            if name not in self.lanes:
+                self.lanes[name] = PriorityExecutor('rpc-' + name, 1, self.max_queue_size, on_error=self.on_error)
+            return self.lanes[name]
+
+    def latency_histogram(self, func_name):
+        with self._mutex:
+            if func_name not in self.latencies:
+                self.latencies[func_name] = MovingHistogram()
+            return self.latencies[func_name]
+
+    def stats(self):
+        with self._mutex:
+            lanes = list(self.lanes.items())
+            latencies = list(self.latencies.items())
+            stats = dict(timed_out=self.timed_out, expired=self.expired, rejected=self.rejected, watched_deadlines=len(self.deadlines))
+
+        stats['lanes'] = dict((name, executor.stats()) for (name, executor) in lanes)
+        stats['latencies'] = dict((name, histogram.as_dict()) for (name, histogram) in latencies)
+        return stats
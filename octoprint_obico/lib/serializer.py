@@ -0,0 +1,199 @@
+# coding=utf-8
+
+### Wire (de)serialization of the messages exchanged with the server.
+#   JSON goes through orjson when it is installed, and through the standard json module otherwise.
+#   Run this file directly for a micro-benchmark of the available backends.
+
+import sys
+import json
+import zlib
+import struct
+import threading
+import bson
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+__python_version__ = 3 if sys.version_info >= (3, 0) else 2
+
+# Same values as websocket.ABNF.OPCODE_TEXT/OPCODE_BINARY
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+
+
+def stdlib_json_dumps(data):
+    if __python_version__ == 3:
+        return json.dumps(data, default=str)
+    else:
+        return json.dumps(data, encoding='iso-8859-1', default=str)
+
+
+if orjson is not None:
+    JSON_BACKEND = 'orjson'
+
+    def json_dumps(data):
+        try:
+            return orjson.dumps(data, default=str, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:  # orjson.JSONEncodeError, e.g. integers over 64 bits. The standard library copes with those.
+            return stdlib_json_dumps(data)
+
+    json_loads = orjson.loads
+else:
+    JSON_BACKEND = 'json'
+    json_dumps = stdlib_json_dumps
+    json_loads = json.loads
+
+
+def dumps(data, as_binary=False):
+    '''
+    Return the wire form of data: BSON bytes if as_binary is True, JSON (str or utf-8 bytes, depending on the backend) otherwise.
+    data can be an OutboundMessage, whose encodings are reused.
+    '''
+    if isinstance(data, OutboundMessage):
+        return data.bson() if as_binary else data.json()
+    if as_binary:
+        return bson.dumps(data)
+    return json_dumps(data)
+
+
+class OutboundMessage(object):
+    '''
+    A message sent through more than one transport (e.g. a passthru response, to the server and over the data channel).
+    Each encoding (JSON, BSON, zlib-compressed JSON) is computed once, on first use, and reused by every transport.
+    data must not be modified once the message is created.
+
+    wrap(key) returns the message {key: data}, whose encodings are built from the ones of this message by byte
+    concatenation instead of serializing data again.
+    '''
+
+    def __init__(self, data, envelope=None):
+        self._mutex = threading.RLock()
+        self.data = data
+        self.envelope = envelope    # (key, inner OutboundMessage) when built by wrap()
+        self.encodings = {}
+
+    def wrap(self, key):
+        return OutboundMessage({key: self.data}, envelope=(key, self))
+
+    def json(self):
+        return self.encoded('json', self._json)
+
+    def bson(self):
+        return self.encoded('bson', self._bson)
+
+    def compressed(self):
+        return self.encoded('zlib', lambda: zlib.compress(self.json()))
+
+    def encoded(self, name, encode):
+        with self._mutex:
+            if name not in self.encodings:
+                self.encodings[name] = encode()
+            return self.encodings[name]
+
+    def _json(self):
+        if self.envelope:
+            (key, inner) = self.envelope
+            return b'{' + to_bytes(stdlib_json_dumps(key)) + b':' + inner.json() + b'}'
+        return to_bytes(json_dumps(self.data))
+
+    def _bson(self):
+        if self.envelope:
+            # A BSON document is: int32 total size | elements | 0x00. An embedded document element is: 0x03 | key | 0x00 | document
+            (key, inner) = self.envelope
+            element = b'\x03' + key.encode('utf8') + b'\x00' + inner.bson()
+            return struct.pack('<i', len(element) + 5) + element + b'\x00'
+        return bson.dumps(self.data)
+
+    def __repr__(self):
+        return 'OutboundMessage({!r})'.format(self.data)
+
+
+def to_bytes(raw):
+    return raw.encode('utf8') if not isinstance(raw, bytes) else raw
+
+
+def loads(raw, opcode=None):
+    '''
+    Parse a message received from the server. The websocket opcode tells whether it is a JSON (text) or a BSON (binary) frame.
+    Without an opcode, JSON is tried first.
+    '''
+    if opcode == OPCODE_BINARY:
+        return bson.loads(raw)
+    if opcode == OPCODE_TEXT:
+        return json_loads(raw)
+
+    try:
+        return json_loads(raw)
+    except ValueError:
+        return bson.loads(raw)
+
+
+if __name__ == "__main__":
+    import os
+    import timeit
+
+    status_corpus = {
+        'current_print_ts': 1700000000,
+        'status': {
+            'state': {'text': 'Printing', 'flags': {'operational': True, 'printing': True, 'cancelling': False, 'pausing': False, 'resuming': False, 'finishing': False, 'closedOrError': False, 'error': False, 'paused': False, 'ready': False, 'sdReady': True}, 'error': ''},
+            'job': {'file': {'name': 'benchy.gcode', 'path': 'benchy.gcode', 'display': 'benchy.gcode', 'origin': 'local', 'size': 5347829, 'date': 1699999000, 'obico_g_code_file_id': 1234}, 'estimatedPrintTime': 4820.3, 'averagePrintTime': None, 'lastPrintTime': None, 'filament': {'tool0': {'length': 5230.1, 'volume': 12.5}}, 'user': 'admin'},
+            'currentZ': 12.4,
+            'progress': {'completion': 42.3, 'filepos': 2262130, 'printTime': 2040, 'printTimeLeft': 2780, 'printTimeLeftOrigin': 'estimate', 'filamentUsed': 5230.1},
+            'offsets': {},
+            'resends': {'count': 0, 'transmitted': 122345, 'ratio': 0},
+            'temperatures': {'tool0': {'actual': 214.8, 'target': 215.0, 'offset': 0}, 'bed': {'actual': 60.1, 'target': 60.0, 'offset': 0}, 'chamber': {'actual': None, 'target': None, 'offset': 0}},
+            '_ts': 1700002040,
+            'currentLayerHeight': 62,
+            'display_status': {'message': None},
+            'file_metadata': {'hash': 'a' * 40, 'analysis': {'printingArea': {'maxX': 180.1, 'maxY': 150.3, 'maxZ': 48.0, 'minX': 40.2, 'minY': 20.1, 'minZ': 0.2}, 'dimensions': {'depth': 130.2, 'height': 47.8, 'width': 139.9}, 'estimatedPrintTime': 4820.3, 'filament': {'tool0': {'length': 5230.1, 'volume': 12.5}}}, 'history': [{'timestamp': 1690000000 + i, 'success': True, 'printerProfile': '_default', 'printTime': 4700.2} for i in range(5)], 'statistics': {'averagePrintTime': {'_default': 4701.1}, 'lastPrintTime': {'_default': 4700.2}}},
+        },
+    }
+    tunnel_corpus = {
+        'http.tunnelv2': {
+            'ref': 'ab12cd34',
+            'response': {
+                'status': 200,
+                'compressed': True,
+                'content': zlib.compress(b'var OctoPrint = {};\n' * 4000 + os.urandom(4000)),
+                'cookies': None,
+                'headers': {'Content-Type': 'application/javascript; charset=UTF-8', 'Cache-Control': 'max-age=0', 'Etag': '"0123456789abcdef"', 'Content-Length': '84000', 'Date': 'Mon, 01 Jan 2024 00:00:00 GMT', 'Server': 'TornadoServer/6.1'},
+            },
+        },
+    }
+    janus_corpus = {
+        'janus': json.dumps({
+            'janus': 'event', 'session_id': 8142397411284011, 'sender': 2851241930519232,
+            'plugindata': {'plugin': 'janus.plugin.streaming', 'data': {'streaming': 'event', 'result': {'status': 'preparing'}}},
+            'jsep': {'type': 'offer', 'sdp': 'v=0\r\no=- 1700000000 1 IN IP4 192.168.1.10\r\ns=Mountpoint 1\r\nt=0 0\r\n' + 'a=candidate:1 1 udp 2015363327 192.168.1.10 41235 typ host\r\n' * 20 + 'm=video 9 UDP/TLS/RTP/SAVPF 96\r\na=rtpmap:96 H264/90000\r\na=fmtp:96 profile-level-id=42e01f;packetization-mode=1\r\n'},
+        }),
+    }
+
+    def bench(label, func, number):
+        secs = timeit.timeit(func, number=number)
+        print('{:<36} {:>10.1f} us/op'.format(label, secs / number * 1e6))
+
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print('JSON backend in use: {}'.format(JSON_BACKEND))
+
+    json_backends = [('json', stdlib_json_dumps, json.loads)]
+    if orjson is not None:
+        json_backends.append(('orjson', json_dumps, orjson.loads))
+
+    for (corpus_name, corpus) in (('status', status_corpus), ('janus', janus_corpus)):
+        for (backend, dumps_func, loads_func) in json_backends:
+            raw = dumps_func(corpus)
+            bench('{} {} dumps ({} bytes)'.format(corpus_name, backend, len(raw)), lambda: dumps_func(corpus), number)
+            bench('{} {} loads'.format(corpus_name, backend), lambda: loads_func(raw), number)
+
+    for (corpus_name, corpus) in (('status', status_corpus), ('tunnel', tunnel_corpus)):
+        raw = bson.dumps(corpus)
+        bench('{} bson dumps ({} bytes)'.format(corpus_name, len(raw)), lambda: bson.dumps(corpus), number)
+        bench('{} bson loads'.format(corpus_name), lambda: bson.loads(raw), number)
+
+    raw_status = json_dumps(status_corpus)
+    bench('status loads, opcode', lambda: loads(raw_status, OPCODE_TEXT), number)
+    raw_tunnel = bson.dumps(tunnel_corpus)
+    bench('tunnel loads, opcode', lambda: loads(raw_tunnel, OPCODE_BINARY), number)
+    bench('tunnel loads, json attempt first', lambda: loads(raw_tunnel), number)
@@ -0,0 +1,201 @@
+import json
+import zlib
+import math
+import time
+import base64
+import threading
+from array import array
+
+# (seconds per sample, number of samples): 10 minutes at 1 s, 1 hour at 10 s, 24 hours at 1 min
+RESOLUTIONS = ((1, 600), (10, 360), (60, 1440))
+
+# Values are sent as integers, in 1/SCALE units, delta-encoded. 0.1 precision is plenty for temperatures, Z and progress.
+SCALE = 10
+
+NAN = float('nan')
+
+
+def series_from_status(status, fan_speed=None):
+    '''
+    Pick the charted values out of PrintJobTracker.status()['status'].
+    '''
+    values = {}
+    for (heater, temps) in (status.get('temperatures') or {}).items():
+        for field in ('actual', 'target'):
+            if isinstance(temps, dict) and temps.get(field) is not None:
+                values['{}.{}'.format(heater, field)] = temps[field]
+
+    completion = (status.get('progress') or {}).get('completion')
+    if completion is not None:
+        values['completion'] = completion
+    if status.get('currentZ') is not None:
+        values['z'] = status['currentZ']
+    if status.get('currentLayerHeight') is not None:
+        values['layer'] = status['currentLayerHeight']
+    if fan_speed is not None:
+        values['fan'] = fan_speed
+    return values
+
+
+def is_active(values):
+    '''
+    True when the printer is doing something worth recording telemetry for: a heater has a target, or a print has progress.
+    '''
+    return any(v for (k, v) in values.items() if k.endswith('.target') or k == 'completion')
+
+
+class Ring(object):
+    '''
+    Fixed-size ring buffer of floats, NaN meaning "no sample".
+    '''
+
+    def __init__(self, capacity):
+        self.values = array('d', [NAN]) * capacity
+        self.capacity = capacity
+
+    def set(self, idx, value):
+        self.values[idx % self.capacity] = value
+
+    def get(self, idx):
+        return self.values[idx % self.capacity]
+
+
+class Level(object):
+    '''
+    One resolution of the store: a ring of bucket timestamps and one ring per series, plus the bucket being accumulated.
+    '''
+
+    def __init__(self, step, capacity):
+        self.step = step
+        self.capacity = capacity
+        self.timestamps = Ring(capacity)
+        self.columns = {}
+        self.count = 0  # Buckets ever written. The ring holds the last min(count, capacity) of them.
+        self.pending_bucket = None
+        self.pending_sums = {}
+        self.pending_counts = {}
+
+    def add(self, ts, values):
+        bucket = int(ts // self.step) * self.step
+        if self.pending_bucket is not None and bucket != self.pending_bucket:
+            self.flush()
+        self.pending_bucket = bucket
+        for (name, value) in values.items():
+            self.pending_sums[name] = self.pending_sums.get(name, 0.0) + value
+            self.pending_counts[name] = self.pending_counts.get(name, 0) + 1
+
+    def flush(self):
+        idx = self.count
+        self.timestamps.set(idx, self.pending_bucket)
+        for (name, column) in self.columns.items():
+            column.set(idx, NAN)
+        for (name, total) in self.pending_sums.items():
+            if name not in self.columns:
+                self.columns[name] = Ring(self.capacity)
+            self.columns[name].set(idx, total / self.pending_counts[name])
+        self.count += 1
+        self.pending_bucket = None
+        self.pending_sums = {}
+        self.pending_counts = {}
+
+    def window(self, since_ts, names=None):
+        '''
+        Return (timestamps, {name: values}) of the buckets after since_ts, oldest first. Missing values are None.
+        '''
+        first = max(0, self.count - self.capacity)
+        indexes = [i for i in range(first, self.count) if self.timestamps.get(i) > since_ts]
+        columns = {}
+        for (name, column) in self.columns.items():
+            if names and name not in names:
+                continue
+            values = [column.get(i) for i in indexes]
+            if any(not math.isnan(v) for v in values):
+                columns[name] = [None if math.isnan(v) else v for v in values]
+        return ([int(self.timestamps.get(i)) for i in indexes], columns)
+
+
+class TimeSeriesStore(object):
+    '''
+    In-process history of temperatures, progress, Z and layer, kept at several resolutions (see RESOLUTIONS) in
+    array-backed ring buffers, so that memory use is fixed. Thread-safe.
+    '''
+
+    def __init__(self, resolutions=RESOLUTIONS):
+        self._mutex = threading.RLock()
+        self.levels = [Level(step, capacity) for (step, capacity) in resolutions]
+
+    def add(self, ts, values):
+        with self._mutex:
+            for level in self.levels:
+                level.add(ts, values)
+
+    def samples_since(self, since_ts, names=None):
+        '''
+        Samples of the finest resolution with timestamps after since_ts.
+        '''
+        with self._mutex:
+            return self.levels[0].window(since_ts, names)
+
+    def get_window(self, seconds=600, series=None, now=None):
+        '''
+        Passthru target: the last `seconds` of history, at the finest resolution that covers them, as a compressed,
+        chart-ready window (see encode_window).
+        '''
+        now = now or time.time()
+        with self._mutex:
+            level = next((l for l in self.levels if l.step * l.capacity >= seconds), self.levels[-1])
+            (timestamps, columns) = level.window(now - seconds, series)
+        return encode_window(level.step, timestamps, columns)
+
+
+def delta_encode(values, scale=SCALE):
+    '''
+    [20.0, 20.5, None, 21.0] -> [200, 5, None, 5]: each value is the difference from the previous non-missing one.
+    '''
+    encoded = []
+    previous = 0
+    for v in values:
+        if v is None:
+            encoded.append(None)
+            continue
+        scaled = int(round(v * scale))
+        encoded.append(scaled - previous)
+        previous = scaled
+    return encoded
+
+
+def delta_decode(encoded, scale=SCALE):
+    values = []
+    previous = 0
+    for d in encoded:
+        if d is None:
+            values.append(None)
+            continue
+        previous += d
+        values.append(float(previous) / scale)
+    return values
+
+
+def encode_window(step, timestamps, columns):
+    '''
+    {'step': seconds per sample, 'encoding': 'delta+json+zlib+base64', 'data': base64 of zlib of JSON
+     {'ts': delta-encoded timestamps (in seconds), 'scale': SCALE, 'series': {name: delta-encoded values}}}
+    '''
+    payload = {
+        'ts': delta_encode(timestamps, scale=1),
+        'scale': SCALE,
+        'series': dict((name, delta_encode(values)) for (name, values) in columns.items()),
+    }
+    raw = json.dumps(payload, separators=(',', ':')).encode('utf8')
+    return {
+        'step': step,
+        'count': len(timestamps),
+        'encoding': 'delta+json+zlib+base64',
+        'data': base64.b64encode(zlib.compress(raw)).decode('ascii'),
+    }
+
+
+def decode_window(window):
+    payload = json.loads(zlib.decompress(base64.b64decode(window['data'])).decode('utf8'))
+    timestamps = [int(t) for t in delta_decode(payload['ts'], scale=1)]
+    return (timestamps, dict((name, delta_decode(values, scale=payload['scale'])) for (name, values) in payload['series'].items()))
@@ -14,6 +14,7 @@ def get_api_commands():
         toggle_sentry_opt=[],
         test_server_connection=[],
         update_printer=['name'],
+        get_tunnel_traces=[],
     )
 
 
@@ -51,11 +52,16 @@ def on_api_command(plugin, command, data):
                     is_connected=plugin.ss and plugin.ss.connected(),
                     status_posted_to_server_ts=plugin.status_posted_to_server_ts,
                     bailed_because_tsd_plugin_running=plugin.bailed_because_tsd_plugin_running,
+                    rtt=plugin.server_ws_rtt.as_dict(),
                 ),
                 linked_printer=plugin.linked_printer,
                 streaming_status=dict(
                     webrtc_streaming=webcam_streamer and not webcam_streamer.shutting_down,),
                 error_stats=error_stats.as_dict(),
+                tunnel_stats=plugin.local_tunnel.stats() if plugin.local_tunnel else None,
+                data_channel_stats=plugin.client_conn.data_channel_stats(),
+                rpc_stats=plugin.client_conn.rpc_stats(),
+                file_metadata_cache=plugin.file_metadata_cache_stats(),
                 alerts=alert_queue.fetch_and_clear(),
             )
             if plugin._settings.get(["auth_token"]):     # Ask to opt in sentry only after wizard is done.
@@ -82,6 +88,9 @@ def on_api_command(plugin, command, data):
             else:
                 return flask.jsonify({'succeeded': False})
 
+        if command == "get_tunnel_traces":
+            return flask.jsonify(plugin.local_tunnel.tracer.stats() if plugin.local_tunnel else None)
+
     except Exception as e:
         plugin.sentry.captureException()
         raise
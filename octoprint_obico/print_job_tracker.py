@@ -3,13 +3,89 @@ import logging
 import time
 import threading
 import os
+from collections import OrderedDict
 from octoprint.filemanager.analysis import QueueEntry
 
 from .utils import server_request, get_file_metadata
+from .lib.serializer import OutboundMessage
 _logger = logging.getLogger('octoprint.plugins.obico')
 
 
 MAX_GCODE_DOWNLOAD_SECONDS = 30 * 60
+STATUS_SNAPSHOT_TICK_SECONDS = 0.5
+FILE_METADATA_CACHE_SIZE = 8
+
+# OctoPrint events after which cached file metadata may be stale
+FILE_METADATA_EVENTS = ('FileAdded', 'FileRemoved', 'UpdatedFiles', 'MetadataAnalysisFinished', 'MetadataStatisticsUpdated')
+
+# This should be consistent with OctoPrint, which only keeps r"^(tool\d+|bed|chamber)$"
+TEMPERATURE_KEY_RE = re.compile(r'^(tool\d+|bed|chamber)$')
+
+
+class StatusSnapshot:
+    '''
+    Printer status at one point in time, shared by every consumer until the next one is built. Must not be modified.
+    '''
+
+    def __init__(self, data, ts):
+        self.data = data
+        self.ts = ts    # When it started to be built. Changes before this are in data
+        self._client_message = None
+
+    def client_message(self):
+        # What status_update_to_client_loop and boost_status_update send over the data channel, serialized at most once
+        if self._client_message is None:
+            self._client_message = OutboundMessage({'status': self.data.get('status', {})})
+        return self._client_message
+
+class FileMetadataCache:
+    '''
+    Metadata of the files being printed, keyed by (origin, path, date, size) so that a replaced file is never served
+    stale metadata. Reading metadata makes OctoPrint load the .metadata.json of the whole folder, which is slow for big
+    folders. Invalidated by the events in FILE_METADATA_EVENTS, so the metadata of a file being printed stays cached for
+    the whole print unless that very file changes. Returned metadata must not be modified.
+    '''
+
+    def __init__(self, max_entries=FILE_METADATA_CACHE_SIZE):
+        self._mutex = threading.RLock()
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, file_manager, current_file):
+        origin = current_file.get('origin')
+        path = current_file.get('path')
+        key = (origin, path, current_file.get('date'), current_file.get('size'))
+        with self._mutex:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+
+        metadata = file_manager._storage_managers.get(origin).get_metadata(path) or {}
+        with self._mutex:
+            self.entries[key] = metadata
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return metadata
+
+    def invalidate(self, origin=None, path=None):
+        '''
+        Drop the metadata of one file, or of all files when path is unknown (e.g. UpdatedFiles).
+        '''
+        with self._mutex:
+            for key in list(self.entries.keys()):
+                if path is None or (key[0] == origin and key[1] == path):
+                    del self.entries[key]
+            self.invalidations += 1
+
+    def stats(self):
+        with self._mutex:
+            return dict(entries=len(self.entries), hits=self.hits, misses=self.misses, invalidations=self.invalidations)
+
 
 class PrintJobTracker:
 
@@ -18,8 +94,13 @@ class PrintJobTracker:
         self.current_print_ts = -1    # timestamp when current print started, acting as a unique identifier for a print
         self.obico_g_code_file_id = None
         self._file_metadata_cache = None
+        self.file_metadata_cache = FileMetadataCache()
         self.current_layer_height = None
         self.gcode_downloading_started = None
+        self.fan_speed = None   # Percent, from the last M106/M107 sent. Only used for telemetry
+        self.snapshot_tick = STATUS_SNAPSHOT_TICK_SECONDS
+        self._snapshot = None
+        self._snapshot_dirty = True
 
     def on_event(self, plugin, event, payload):
 
@@ -43,6 +124,7 @@ class PrintJobTracker:
             with self._mutex:
                 self.current_print_ts = int(time.time())
                 self._file_metadata_cache = None
+                self._snapshot_dirty = True
 
             self.set_obico_g_code_file_id(find_obico_g_code_file_id(payload))
 
@@ -59,13 +141,63 @@ class PrintJobTracker:
                 self.set_obico_g_code_file_id(None)
                 self._file_metadata_cache = None
                 self.current_layer_height = None
+                self._snapshot_dirty = True
 
                 # First layer AI
                 plugin.nozzlecam.on_first_layer = False # catch-all to make sure /nozzle_cam/first_layer_done/ is called in case such as canceled mid first layer.
 
         return data
 
+    def mark_dirty(self):
+        '''
+        Something in the status changed. The next call to status() builds a new snapshot even within the same tick.
+        '''
+        with self._mutex:
+            self._snapshot_dirty = True
+
+    def status_snapshot(self, plugin, changed_ts=None):
+        '''
+        Return the current StatusSnapshot. It is rebuilt at most once per snapshot_tick, unless marked dirty or older
+        than changed_ts, the time of a change the caller needs to see.
+        '''
+        with self._mutex:
+            snapshot = self._snapshot
+            if snapshot and not self._snapshot_dirty and time.time() - snapshot.ts < self.snapshot_tick \
+                    and (changed_ts is None or snapshot.ts >= changed_ts):
+                return snapshot
+            self._snapshot_dirty = False
+
+        build_ts = time.time()
+        snapshot = StatusSnapshot(self.build_status(plugin), ts=build_ts)
+        with self._mutex:
+            self._snapshot = snapshot
+        return snapshot
+
     def status(self, plugin, status_only=False):
+        '''
+        With status_only, return the data of the shared snapshot, which must not be modified.
+        Otherwise, return a copy of it with file metadata and OctoPrint settings added, which is the caller's to modify.
+        '''
+        snapshot = self.status_snapshot(plugin)
+        if status_only:
+            return snapshot.data
+
+        data = dict(snapshot.data)
+        data['status'] = dict(snapshot.data['status'])
+        file_metadata = self.get_file_metadata(plugin, data)
+        with self._mutex:
+            if file_metadata != self._file_metadata_cache:
+                self._file_metadata_cache = file_metadata
+                self._snapshot_dirty = True
+        data['status']['file_metadata'] = file_metadata
+
+        octo_settings = plugin.octoprint_settings_updater.as_dict()
+        if octo_settings:
+            data['settings'] = octo_settings
+
+        return data
+
+    def build_status(self, plugin):
         data = {
             'status': plugin._printer.get_current_data()
         }
@@ -86,10 +218,10 @@ class PrintJobTracker:
                     data['status']['state']['text'] = 'G-Code Downloading'
                     data['status']['state']['flags']['operational'] = False
 
-        # Apparently printers like Prusa throws random temperatures here. This should be consistent with OctoPrint, which only keeps r"^(tool\d+|bed|chamber)$"
+        # Apparently printers like Prusa throws random temperatures here.
         temperatures = {}
         for (k,v) in plugin._printer.get_current_temperatures().items():
-            if re.search(r'^(tool\d+|bed|chamber)$', k):
+            if TEMPERATURE_KEY_RE.match(k):
                 temperatures[k] = v
 
         data['status']['temperatures'] = temperatures
@@ -105,26 +237,23 @@ class PrintJobTracker:
             if filament_length is not None:
                 progress['filamentUsed'] = filament_length
 
-        if status_only:
-            if self._file_metadata_cache:
-                data['status']['file_metadata'] = self._file_metadata_cache
-            return data
-
-        data['status']['file_metadata'] = self._file_metadata_cache = self.get_file_metadata(plugin, data)
-
-        octo_settings = plugin.octoprint_settings_updater.as_dict()
-        if octo_settings:
-            data['settings'] = octo_settings
+        if self._file_metadata_cache:
+            data['status']['file_metadata'] = self._file_metadata_cache
 
         return data
 
     def increment_layer_height(self, val):
         with self._mutex:
             self.current_layer_height = val
+            self._snapshot_dirty = True
+
+    def set_fan_speed(self, fan_speed):
+        self.fan_speed = fan_speed
 
     def set_obico_g_code_file_id(self, obico_g_code_file_id):
         with self._mutex:
             self.obico_g_code_file_id = obico_g_code_file_id
+            self._snapshot_dirty = True
 
     def get_obico_g_code_file_id(self):
         with self._mutex:
@@ -133,6 +262,7 @@ class PrintJobTracker:
     def set_gcode_downloading_started(self, timestamp):
         with self._mutex:
             self.gcode_downloading_started = timestamp
+            self._snapshot_dirty = True
 
     def get_file_metadata(self, plugin, data):
         try:
@@ -142,7 +272,7 @@ class PrintJobTracker:
             if not origin or not path:
                 return None
 
-            return plugin._file_manager._storage_managers.get(origin).get_metadata(path) or {}
+            return self.file_metadata_cache.get(plugin._file_manager, current_file)
         except Exception as e:
             _logger.exception(e)
             return None
@@ -0,0 +1,116 @@
+import time
+import logging
+import threading
+
+from octoprint.printer import PrinterCallback
+
+_logger = logging.getLogger('octoprint.plugins.obico')
+
+CLIENT_MIN_INTERVAL_SECONDS = 0.75
+CLIENT_KEEPALIVE_SECONDS = 10.0     # An idle printer still sends its status to clients this often
+SERVER_MIN_INTERVAL_SECONDS = 10.0
+SERVER_KEEPALIVE_SECONDS = 50.0
+TELEMETRY_INTERVAL_SECONDS = 10.0   # Samples between full statuses go to the server in batches this often
+
+# Fields of OctoPrint's current data that, when changed, are worth telling the server about right away
+SERVER_STATE_KEYS = ('state', 'job')
+
+
+class StatusPusher:
+    '''
+    Decides when the printer status is sent to clients (data channel) and to the server, instead of polling at a
+    fixed cadence. Changes are flagged with mark_dirty(). Clients get them at most once per CLIENT_MIN_INTERVAL_SECONDS,
+    the server at most once per SERVER_MIN_INTERVAL_SECONDS and only for state transitions. Both still get the
+    status every *_KEEPALIVE_SECONDS when nothing changes. What happens in between (temperatures, progress, ...)
+    reaches the server as telemetry batches, every TELEMETRY_INTERVAL_SECONDS.
+
+    on_state_change is called for state transitions only. Temperatures and progress change all the time while printing,
+    and the status snapshot picks them up when its tick expires.
+    '''
+
+    def __init__(self, on_state_change=None):
+        self._mutex = threading.RLock()
+        self.on_state_change = on_state_change
+        self.client_wakeup = threading.Event()
+        self.client_changed_ts = None
+        self.last_client_push_ts = 0
+        self.server_dirty = False
+        self.last_telemetry_ts = time.time()
+
+    def mark_dirty(self, server=False):
+        if server:
+            if self.on_state_change:
+                self.on_state_change()
+            with self._mutex:
+                self.server_dirty = True
+        with self._mutex:
+            self.client_changed_ts = time.time()
+            self.client_wakeup.set()
+
+    def wait_for_client_push(self):
+        '''
+        Block until the status should be pushed to clients. Return the time of the last change flagged since the
+        previous push, or None for a keepalive. The pushed status must be built after it: the change may be one the
+        status snapshot would otherwise only pick up when its tick expires (e.g. a new target temperature).
+        '''
+        self.client_wakeup.wait(CLIENT_KEEPALIVE_SECONDS)
+
+        wait = self.last_client_push_ts + CLIENT_MIN_INTERVAL_SECONDS - time.time()
+        if wait > 0:
+            time.sleep(wait)    # Changes flagged meanwhile go out with this push
+        with self._mutex:
+            # Changes flagged after this wake the next push
+            self.client_wakeup.clear()
+            changed_ts = self.client_changed_ts
+            self.client_changed_ts = None
+        self.last_client_push_ts = time.time()
+        return changed_ts
+
+    def server_push_due(self, last_posted_ts):
+        since_last = time.time() - last_posted_ts
+        with self._mutex:
+            return since_last >= SERVER_KEEPALIVE_SECONDS or (self.server_dirty and since_last >= SERVER_MIN_INTERVAL_SECONDS)
+
+    def server_pushed(self):
+        with self._mutex:
+            self.server_dirty = False
+
+    def telemetry_due(self):
+        with self._mutex:
+            if time.time() - self.last_telemetry_ts < TELEMETRY_INTERVAL_SECONDS:
+                return False
+            self.last_telemetry_ts = time.time()
+            return True
+
+
+class StatusPushCallback(PrinterCallback):
+    '''
+    Registered with OctoPrint's printer, which calls it from its own threads. It only compares what OctoPrint reports
+    with what was last seen and flags changes. Sending happens in the plugin's loops.
+    '''
+
+    def __init__(self, pusher):
+        self.pusher = pusher
+        self.last_temperatures = None
+        self.last_current = None
+        self.last_server_state = None
+
+    def on_printer_add_temperature(self, data):
+        # Temperatures are reported every few seconds even when idle. Sub-degree jitter is not worth a push.
+        temperatures = tuple(sorted(
+            (k, round(v.get('actual') or 0), v.get('target'))
+            for (k, v) in data.items() if isinstance(v, dict)))
+        if temperatures != self.last_temperatures:
+            self.last_temperatures = temperatures
+            self.pusher.mark_dirty()
+
+    def on_printer_send_current_data(self, data):
+        server_state = tuple(repr(data.get(k)) for k in SERVER_STATE_KEYS)
+        current = (server_state, repr(data.get('progress')), data.get('currentZ'))
+        if current == self.last_current:
+            return
+
+        self.last_current = current
+        server_changed = server_state != self.last_server_state
+        self.last_server_state = server_state
+        self.pusher.mark_dirty(server=server_changed)
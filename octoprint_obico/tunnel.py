@@ -1,4 +1,5 @@
 import requests
+from requests.adapters import HTTPAdapter
 import pickle
 import logging
 import threading
@@ -6,53 +7,219 @@ import time
 import os
 import sys
 import zlib
+import re
+import itertools
 try:
     from urllib.parse import urljoin
 except ImportError:
     from urlparse import urljoin
+try:
+    from http.cookiejar import DefaultCookiePolicy
+except ImportError:
+    from cookielib import DefaultCookiePolicy
 
-from .ws import WebSocketClient
+from .ws import BufferedWebSocketClient
+from .tunnel_shaper import PushTrafficShaper
+from .lib.debug_log import SampledDebugLogger
+from .lib.priority_executor import PriorityExecutor
+from .lib.compression_policy import CompressionPolicy
+from .lib.response_cache import ResponseCache, cache_key, is_cacheable_response, is_not_modified, without_conditional_headers
+from .lib.request_tracer import RequestTracer
 
 WRITE_MODE = 'w' if sys.version_info[0] < 3 else 'wb'
 READ_MODE = 'r' if sys.version_info[0] < 3 else 'rb'
-COMPRESS_THRESHOLD = 1000
+COOKIE_FLUSH_DELAY_SECONDS = 5.0
+TUNNEL_WORKERS = 4
+TUNNEL_MAX_QUEUE_SIZE = 200
+
+# Streaming (v2 only): responses of unknown length or at least STREAM_THRESHOLD bytes are sent in chunks when the server asks for it.
+STREAM_THRESHOLD = 1024 * 1024
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_MAX_BACKLOG = 8    # Don't read the next chunk while this many messages are waiting to be sent to the server
+STREAM_SEND_TIMEOUT = 60
+# Streams can last minutes. They run in their own workers, so that downloads and timelapse seeks never hold up the
+# tunnel workers, and with them API and UI requests. A stream waiting for a worker holds its connection to OctoPrint.
+STREAM_WORKERS = 2
+STREAM_MAX_QUEUE_SIZE = 8
+
+# An aborted download or a seek in a video doesn't propagate through the tunnel. Open-ended ranges ('bytes=N-') are
+# capped so that a seek doesn't keep the tunnel busy with the rest of the file. Clients ask for the next range as needed.
+MAX_OPEN_RANGE_BYTES = 8 * 1024 * 1024
+OPEN_RANGE_RE = re.compile(r'^\s*bytes\s*=\s*(\d+)\s*-\s*$')
+
+# Lower value = served first. API calls go before page loads, which go before static assets.
+PRIORITY_API = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_STATIC = 2
+STATIC_ASSET_PATH_RE = re.compile(r'^/(static|plugin/[^/]+/static)/')
 
 _logger = logging.getLogger('octoprint.plugins.obico')
+_hot_path_logger = SampledDebugLogger(_logger)
+_thread_time = getattr(time, 'thread_time', time.time)
+
+
+class DebouncedCookieStore(object):
+    '''
+    Persists the cookie jar of a requests session. Changes are written at most once per delay, and only if the cookies
+    actually changed, through a temp file that is renamed over the old one so that a crash never leaves a corrupted jar.
+    '''
+
+    def __init__(self, path, session, delay=COOKIE_FLUSH_DELAY_SECONDS):
+        self._mutex = threading.RLock()
+        self.path = path
+        self.session = session
+        self.delay = delay
+        self.flush_timer = None
+        try:
+            with open(self.path, READ_MODE) as fp:
+                jar = pickle.load(fp)
+                if isinstance(jar, requests.cookies.RequestsCookieJar):
+                    self.session.cookies = jar
+        except:
+            pass   # Start with a clean session without cookies if cookie jar loading fails for any reason
+        self.saved_fingerprint = self.fingerprint()
+
+    def fingerprint(self):
+        with self.session.cookies._cookies_lock:
+            return sorted((c.domain, c.path, c.name, c.value, c.expires) for c in self.session.cookies)
+
+    def mark_dirty(self):
+        with self._mutex:
+            if self.flush_timer is None:
+                self.flush_timer = threading.Timer(self.delay, self.flush)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+
+    def flush(self):
+        with self._mutex:
+            if self.flush_timer:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+
+            fingerprint = self.fingerprint()
+            if fingerprint == self.saved_fingerprint:
+                return
+
+            try:
+                with self.session.cookies._cookies_lock:
+                    pickled = pickle.dumps(self.session.cookies)
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, WRITE_MODE) as fp:
+                    fp.write(pickled)
+                    fp.flush()
+                    os.fsync(fp.fileno())
+                os.rename(tmp_path, self.path)
+                self.saved_fingerprint = fingerprint
+            except Exception as e:
+                _logger.warning('Failed to save tunnel cookies - {}'.format(e))
+
+    def close(self):
+        self.flush()
 
 
 class LocalTunnel(object):
 
-    def __init__(self, base_url, on_http_response, on_ws_message, data_dir, sentry):
+    def __init__(self, base_url, on_http_response, on_ws_message, data_dir, sentry, workers=TUNNEL_WORKERS, max_queue_size=TUNNEL_MAX_QUEUE_SIZE, outbound_backlog=None, cache_version=None, trace_path=None):
         self.base_url = base_url
         self.on_http_response = on_http_response
         self.on_ws_message = on_ws_message
+        self.outbound_backlog = outbound_backlog or (lambda: 0)
         self.sentry = sentry
+        self.executor = PriorityExecutor('tunnel', workers, max_queue_size, on_error=sentry.captureException)
+        self.stream_executor = PriorityExecutor('tunnel-stream', STREAM_WORKERS, STREAM_MAX_QUEUE_SIZE, on_error=sentry.captureException)
+        self.compression_policy = CompressionPolicy()
+        self.response_cache = ResponseCache(version=cache_version)
+        self.tracer = RequestTracer(trace_path=trace_path)
         self.ref_to_ws = {}
-        self.cj_path = os.path.join(data_dir, '.tunnel.cj.pickled')
-        self.request_session = requests.Session()
-        try:
-            with open(self.cj_path, READ_MODE) as fp:
-                jar = pickle.load(fp)
-                if isinstance(jar, requests.cookies.RequestsCookieJar):
-                    self.request_session.cookies = jar
-        except:
-            pass   # Start with a clean session without cookies if cookie jar loading fails for any reason
+        self.ref_to_shaper = {}
+        self.request_session = pooled_session(workers)
+        self.request_session_v2 = pooled_session(workers + STREAM_WORKERS, stateless=True)    # v2 forwards Set-Cookie to the browser. Cookies must never stick to the session
+        self.cookie_store = DebouncedCookieStore(os.path.join(data_dir, '.tunnel.cj.pickled'), self.request_session)
+
+    def enqueue_http_to_local(self, **kwargs):
+        self._enqueue(self.send_http_to_local, 'http.tunnel', kwargs)
+
+    def enqueue_http_to_local_v2(self, **kwargs):
+        self._enqueue(self.send_http_to_local_v2, 'http.tunnelv2', kwargs)
+
+    def _enqueue(self, send_func, msg_key, kwargs):
+        kwargs['trace'] = self.tracer.start(kwargs.get('ref'), kwargs.get('method'), kwargs.get('path'))
+        if self.executor.submit(send_func, request_priority(kwargs.get('path')), **kwargs):
+            return
+
+        _logger.warning('Tunnel queue is full. Rejecting "{}"'.format(kwargs.get('path')))
+        self.on_http_response(
+            {msg_key: {'ref': kwargs.get('ref'), 'response': {'status': 503, 'content': 'Too many tunnel requests queued', 'headers': {}}}},
+            as_binary=True)
+
+    def stats(self):
+        return dict(executor=self.executor.stats(), stream_executor=self.stream_executor.stats(), compression=self.compression_policy.stats(), cache=self.response_cache.stats(), traces=self.tracer.stats())
+
+    def lookup_cache(self, method, path, params, headers):
+        '''
+        Return (key, cached response data). key is None when the request is not cacheable. Only static assets are cached.
+        '''
+        if method.lower() != 'get' or not STATIC_ASSET_PATH_RE.match(path or ''):
+            return (None, None)
+
+        if header_value(headers, 'Range') is not None:  # Partial content is not cached
+            return (None, None)
+
+        key = cache_key(method, path, params, headers)
+        entry = self.response_cache.get(key)
+        if entry is None:
+            return (key, None)
+
+        if is_not_modified(headers, entry['headers']):
+            return (key, self.not_modified_response(entry['headers']))
+
+        return (key, {
+            'status': entry['status'],
+            'compressed': entry['compressed'],
+            'content': entry['content'],
+            'headers': dict(entry['headers']),
+        })
+
+    def not_modified_response(self, response_headers):
+        self.response_cache.count_not_modified()
+        return {
+            'status': 304,
+            'compressed': False,
+            'content': b'',
+            'headers': {k: v for k, v in response_headers.items() if k.lower() != 'content-length'},
+        }
 
     def send_http_to_local(
             self, ref, method, path,
-            params=None, data=None, headers=None, timeout=30):
+            params=None, data=None, headers=None, timeout=30, trace=None):
 
         url = urljoin(self.base_url, path)
+        trace = trace or self.tracer.start(ref, method, path)
+        trace.start()
+
+        _hot_path_logger.debug('Tunneling "%s"', url)
+
+        (key, cached) = self.lookup_cache(method, path, params, headers)
+        if cached:
+            trace.cached = True
+            trace.fetched(cached['status'])
+            self.on_http_response(
+                {'http.tunnel': {'ref': ref, 'response': cached}},
+                as_binary=True,
+                on_sent=trace.sent_last)
+            return
 
-        _logger.debug('Tunneling "{}"'.format(url))
         try:
             resp = getattr(self.request_session, method)(
                 url,
                 params=params,
-                headers={k: v for k, v in headers.items() if k != 'Cookie'},
+                headers=bounded_range({k: v for k, v in (without_conditional_headers(headers) if key else headers).items() if k != 'Cookie'}),
                 data=data,
                 timeout=timeout,
                 allow_redirects=False)
+            trace.fetched(resp.status_code)
+
+            cacheable = key is not None and is_cacheable_response(resp.status_code, resp.headers)
 
             save_cookies = False
             if resp.status_code == 403:      # failed to authenticate
@@ -60,17 +227,23 @@ class LocalTunnel(object):
                 save_cookies = True
 
             if resp.headers.pop('Set-Cookie', None) or save_cookies: # Stop set-cookie from being propagated to Obico Server
-                with open(self.cj_path, WRITE_MODE) as fp:
-                    pickle.dump(self.request_session.cookies, fp)
+                self.cookie_store.mark_dirty()
 
-            compress = len(resp.content) >= COMPRESS_THRESHOLD
+            started = _thread_time()
+            (compressed, content) = self.compression_policy.compress(path, resp.headers, resp.content)
+            trace.add_compress(_thread_time() - started)
             resp_data = {
                 'status': resp.status_code,
-                'compressed': compress,
-                'content': zlib.compress(resp.content) if compress else resp.content,
+                'compressed': compressed,
+                'content': content,
                 'headers': {k: v for k, v in resp.headers.items()},
             }
+            if cacheable:
+                self.response_cache.put(key, resp.status_code, compressed, content, resp_data['headers'], etag=resp.headers.get('ETag'))
+            if key is not None and resp.status_code == 200 and is_not_modified(headers, resp_data['headers']):
+                resp_data = self.not_modified_response(resp_data['headers'])     # What OctoPrint would have answered
         except Exception as ex:
+            trace.fetched(502)
             resp_data = {
                 'status': 502,
                 'content': repr(ex),
@@ -79,38 +252,56 @@ class LocalTunnel(object):
 
         self.on_http_response(
             {'http.tunnel': {'ref': ref, 'response': resp_data}},
-            as_binary=True)
+            as_binary=True,
+            on_sent=trace.sent_last)
         return
 
     def send_ws_to_local(self, ref, path, data, type_):
         ws = self.ref_to_ws.get(ref, None)
 
+        if type_ == 'tunnel_config':    # e.g. {'min_interval': 2, 'strip_terminal': True} when the remote terminal is hidden
+            self.shaper_for(ref).configure(**(data or {}))
+            return
+
         if type_ == 'tunnel_close':
             if ws is not None:
                 ws.close()
             return
 
         if ws is None:
-            self.connect_octoprint_ws(ref, path)
-            time.sleep(1)  # Wait to make sure websocket is established before `send` is called
+            ws = self.connect_octoprint_ws(ref, path)    # Doesn't block. Frames sent before it is open are queued
 
         if data is not None:
             ws.send(data)
 
+    def shaper_for(self, ref):
+        shaper = self.ref_to_shaper.get(ref)
+        if shaper is None:
+            def send(data):
+                self.on_ws_message(
+                    {'ws.tunnel': {'ref': ref, 'data': data, 'type': 'octoprint_message'}},
+                    as_binary=True)
+
+            shaper = self.ref_to_shaper[ref] = PushTrafficShaper(send, on_error=self.sentry.captureException)
+        return shaper
+
     def connect_octoprint_ws(self, ref, path):
         def on_ws_close(ws, **kwargs):
             _logger.info("OctoPrint WS is closing")
+            shaper = self.ref_to_shaper.pop(ref, None)
+            if shaper:
+                shaper.close()
             if ref in self.ref_to_ws:
                 del self.ref_to_ws[ref]     # Remove octoprint ws from refs as on_ws_message may fail
                 self.on_ws_message(
                     {'ws.tunnel': {'ref': ref, 'data': None, 'type': 'octoprint_close'}},
                     as_binary=True)
 
+        shaper = self.shaper_for(ref)
+
         def on_ws_msg(ws, data):
             try:
-                self.on_ws_message(
-                    {'ws.tunnel': {'ref': ref, 'data': data, 'type': 'octoprint_message'}},
-                    as_binary=True)
+                shaper.process(data)
             except:
                 self.sentry.captureException()
                 ws.close()
@@ -119,32 +310,53 @@ class LocalTunnel(object):
         url = url.replace('http://', 'ws://')
         url = url.replace('https://', 'wss://')
 
-        ws = WebSocketClient(
+        ws = BufferedWebSocketClient(
             url,
             token=None,
             on_ws_msg=on_ws_msg,
             on_ws_close=on_ws_close,
         )
         self.ref_to_ws[ref] = ws
+        ws.connect()
+        return ws
+
+    def close(self):
+        self.close_all_octoprint_ws()
+        self.cookie_store.close()
 
     def close_all_octoprint_ws(self):
-        for ref, ws in self.ref_to_ws.items():
+        for ref, ws in list(self.ref_to_ws.items()):
             ws.close()
 
     def send_http_to_local_v2(
             self, ref, method, path,
-            params=None, data=None, headers=None, timeout=30):
+            params=None, data=None, headers=None, timeout=30, stream=False, trace=None):
 
         url = urljoin(self.base_url, path)
+        trace = trace or self.tracer.start(ref, method, path)
+        trace.start()
+
+        _hot_path_logger.debug('Tunneling (v2) "%s"', url)
+
+        (key, cached) = self.lookup_cache(method, path, params, headers)
+        if cached:
+            cached['cookies'] = None
+            trace.cached = True
+            trace.fetched(cached['status'])
+            self.on_http_response(
+                {'http.tunnelv2': {'ref': ref, 'response': cached}},
+                as_binary=True,
+                on_sent=trace.sent_last)
+            return
 
-        _logger.debug('Tunneling (v2) "{}"'.format(url))
         try:
-            resp = getattr(requests, method)(
+            resp = getattr(self.request_session_v2, method)(
                 url,
                 params=params,
-                headers={k: v for k, v in headers.items()},
+                headers=bounded_range({k: v for k, v in (without_conditional_headers(headers) if key else headers).items()}),
                 data=data,
                 timeout=timeout,
+                stream=True,    # Body is read below, either all at once or in chunks
                 allow_redirects=False) # The redirect should happen in the browser, not the plugin. Otherwise it causes tricky problems.
 
             if sys.version_info[0] < 3:
@@ -156,19 +368,46 @@ class LocalTunnel(object):
             else:
                 cookies = resp.raw._original_response.msg.get_all('Set-Cookie')
 
-            compress = len(resp.content) >= COMPRESS_THRESHOLD
+            if key is not None and resp.status_code == 200 and is_not_modified(headers, resp.headers) and should_stream(resp):
+                resp.close()    # Too big to cache, and the browser has it already. No need to read the body.
+                trace.fetched(304)
+                self.on_http_response(
+                    {'http.tunnelv2': {'ref': ref, 'response': dict(self.not_modified_response(resp.headers), cookies=cookies)}},
+                    as_binary=True,
+                    on_sent=trace.sent_last)
+                return
+
+            if stream and should_stream(resp):
+                if self.stream_executor.submit(self.stream_http_response_v2, ref=ref, path=path, resp=resp, cookies=cookies, trace=trace):
+                    return
+
+                resp.close()
+                _logger.warning('Too many tunnel streams queued. Rejecting "{}"'.format(path))
+                trace.fetched(503)
+                self.on_http_response(
+                    {'http.tunnelv2': {'ref': ref, 'response': {'status': 503, 'content': 'Too many tunnel streams queued', 'headers': {}}}},
+                    as_binary=True,
+                    on_sent=trace.sent_last)
+                return
+
+            content = resp.content
+            trace.fetched(resp.status_code)
+            started = _thread_time()
+            (compressed, content) = self.compression_policy.compress(path, resp.headers, content)
+            trace.add_compress(_thread_time() - started)
             resp_data = {
                 'status': resp.status_code,
-                'compressed': compress,
-                'content': (
-                    zlib.compress(resp.content)
-                    if compress
-                    else resp.content
-                ),
+                'compressed': compressed,
+                'content': content,
                 'cookies': cookies,
                 'headers': {k: v for k, v in resp.headers.items()},
             }
+            if key is not None and not cookies and is_cacheable_response(resp.status_code, resp.headers):
+                self.response_cache.put(key, resp.status_code, compressed, content, resp_data['headers'], etag=resp.headers.get('ETag'))
+            if key is not None and resp.status_code == 200 and is_not_modified(headers, resp_data['headers']):
+                resp_data = dict(self.not_modified_response(resp_data['headers']), cookies=cookies)     # What OctoPrint would have answered
         except Exception as ex:
+            trace.fetched(502)
             resp_data = {
                 'status': 502,
                 'content': repr(ex),
@@ -177,5 +416,127 @@ class LocalTunnel(object):
 
         self.on_http_response(
             {'http.tunnelv2': {'ref': ref, 'response': resp_data}},
-            as_binary=True)
+            as_binary=True,
+            on_sent=trace.sent_last)
         return
+
+    def stream_http_response_v2(self, ref, path, resp, cookies, trace):
+        '''
+        Send a response to the server as a sequence of 'http.tunnelv2.stream' messages, so that memory use does not grow
+        with the response size:
+          - {'type': 'start', 'response': {status, headers, cookies, compressed}}
+          - {'type': 'chunk', 'seq': 0, 1, ..., 'content': ...}. When compressed, chunks of one response are pieces of a
+            single zlib stream, each ending on a sync flush, so they can be decompressed as they arrive.
+          - {'type': 'end', 'chunks': number of chunks sent, 'error': None or what went wrong}
+        '''
+        def send(msg):
+            msg['ref'] = ref
+            on_sent = trace.sent_last if msg['type'] == 'end' else trace.sent
+            self.on_http_response({'http.tunnelv2.stream': msg}, as_binary=True, on_sent=on_sent)
+
+        seq = 0
+        error = None
+        start_sent = False
+        try:
+            pieces = resp.iter_content(STREAM_CHUNK_SIZE)
+            first_piece = next(pieces, b'')
+
+            # The first piece of the body is enough to tell if it is worth compressing
+            (level, category) = self.compression_policy.choose(path, resp.headers, first_piece[:16])
+            compressor = zlib.compressobj(level) if level is not None else None
+            send({
+                'type': 'start',
+                'response': {
+                    'status': resp.status_code,
+                    'compressed': compressor is not None,
+                    'cookies': cookies,
+                    'headers': {k: v for k, v in resp.headers.items()},
+                }})
+            start_sent = True
+
+            for piece in itertools.chain([first_piece], pieces):
+                if not piece:
+                    continue
+                if not self.wait_for_outbound_room():
+                    raise Exception('Timed out waiting for the server connection to drain')
+
+                content = piece
+                cpu_seconds = 0
+                if compressor:
+                    started = _thread_time()
+                    content = compressor.compress(piece) + compressor.flush(zlib.Z_SYNC_FLUSH)
+                    cpu_seconds = _thread_time() - started
+                self.compression_policy.record(category, len(piece), len(content), cpu_seconds)
+                trace.add_compress(cpu_seconds)
+
+                send({
+                    'type': 'chunk',
+                    'seq': seq,
+                    'content': content,
+                })
+                seq += 1
+        except Exception as ex:
+            error = repr(ex)
+            if not start_sent:
+                send({'type': 'start', 'response': {'status': 502, 'compressed': False, 'headers': {}}})
+        finally:
+            resp.close()
+            trace.fetched(resp.status_code)   # For a streamed response, fetch spans until the body is fully read
+
+        send({'type': 'end', 'chunks': seq, 'error': error})
+
+    def wait_for_outbound_room(self):
+        deadline = time.time() + STREAM_SEND_TIMEOUT
+        while self.outbound_backlog() >= STREAM_MAX_BACKLOG:
+            if time.time() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+
+def should_stream(resp):
+    try:
+        return int(resp.headers.get('Content-Length')) >= STREAM_THRESHOLD
+    except (TypeError, ValueError):  # No Content-Length, e.g. chunked transfer encoding
+        return True
+
+
+def header_value(headers, name):
+    name = name.lower()
+    for (k, v) in (headers or {}).items():
+        if k.lower() == name:
+            return v
+    return None
+
+
+def bounded_range(headers):
+    # Range (and If-Range) are forwarded to OctoPrint as is, so that 206 responses keep their Content-Range.
+    # Only open-ended ranges are capped to MAX_OPEN_RANGE_BYTES.
+    for (k, v) in headers.items():
+        if k.lower() == 'range':
+            m = OPEN_RANGE_RE.match(v or '')
+            if m:
+                start = int(m.group(1))
+                headers[k] = 'bytes={}-{}'.format(start, start + MAX_OPEN_RANGE_BYTES - 1)
+            break
+    return headers
+
+
+def pooled_session(pool_size, stateless=False):
+    # Keep-alive connections to OctoPrint, one per tunnel worker, so that requests don't pay for a TCP handshake each time
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if stateless:
+        session.cookies = requests.cookies.RequestsCookieJar(policy=DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+
+def request_priority(path):
+    path = path or ''
+    if STATIC_ASSET_PATH_RE.match(path):
+        return PRIORITY_STATIC
+    if path.startswith('/api/') or path.startswith('/plugin/'):
+        return PRIORITY_API
+    return PRIORITY_DEFAULT
@@ -0,0 +1,140 @@
+import json
+import time
+import logging
+import threading
+
+_logger = logging.getLogger('octoprint.plugins.obico')
+
+CURRENT_MIN_INTERVAL_SECONDS = 1.0
+
+# Lists in a 'current' push message only contain what is new since the previous one. They are concatenated when coalescing.
+INCREMENTAL_KEYS = ('logs', 'messages', 'temps')
+TERMINAL_KEYS = ('logs', 'messages')
+
+
+class PushTrafficShaper:
+    '''
+    Shapes the traffic of one tunnelled OctoPrint push socket (SockJS 'a[...]' frames, or plain JSON frames on the raw
+    websocket endpoint). 'current' updates are coalesced to at most one per min_interval, terminal lines are stripped
+    when the remote terminal is hidden, and updates that change nothing are dropped. Everything else, including
+    SockJS open/heartbeat/close frames, is passed through as is.
+    '''
+
+    def __init__(self, send, min_interval=CURRENT_MIN_INTERVAL_SECONDS, strip_terminal=False, dedupe=True, on_error=None):
+        self._mutex = threading.RLock()
+        self.send = send
+        self.on_error = on_error
+        self.min_interval = min_interval
+        self.strip_terminal = strip_terminal
+        self.dedupe = dedupe
+        self.sockjs = True
+        self.pending_current = None
+        self.flush_timer = None
+        self.last_sent_ts = 0
+        self.last_signature = None
+
+    def configure(self, min_interval=None, strip_terminal=None, dedupe=None, **kwargs):
+        with self._mutex:
+            if min_interval is not None:
+                self.min_interval = float(min_interval)
+            if strip_terminal is not None:
+                self.strip_terminal = bool(strip_terminal)
+            if dedupe is not None:
+                self.dedupe = bool(dedupe)
+
+    def process(self, frame):
+        messages = self.parse(frame)
+        if messages is None:
+            self.send(frame)
+            return
+
+        others = []
+        for msg in messages:
+            if isinstance(msg, dict) and len(msg) == 1 and 'current' in msg:
+                self.add_current(msg['current'])
+            else:
+                others.append(msg)
+
+        if others:
+            with self._mutex:
+                self.flush()    # Whatever came before these messages goes out first
+                self.send_messages(others)
+
+    def parse(self, frame):
+        try:
+            if frame.startswith('a['):
+                self.sockjs = True
+                return json.loads(frame[1:])
+            if frame.startswith('{'):
+                self.sockjs = False
+                return [json.loads(frame)]
+        except (AttributeError, ValueError):    # Not text, or not json
+            pass
+        return None
+
+    def add_current(self, current):
+        with self._mutex:
+            if self.pending_current:
+                merged = dict(current)
+                for k in INCREMENTAL_KEYS:
+                    merged[k] = (self.pending_current.get(k) or []) + (current.get(k) or [])
+                current = merged
+            self.pending_current = current
+
+            wait = self.last_sent_ts + self.min_interval - time.time()
+            if wait <= 0:
+                self.flush()
+            elif self.flush_timer is None:
+                self.flush_timer = threading.Timer(wait, self.flush_safely)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+
+    def flush_safely(self):
+        try:
+            self.flush()
+        except Exception:
+            if self.on_error:
+                self.on_error()
+
+    def flush(self):
+        with self._mutex:
+            if self.flush_timer:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+
+            current = self.pending_current
+            self.pending_current = None
+            if current is None:
+                return
+
+            if self.strip_terminal:
+                current = dict(current)
+                for k in TERMINAL_KEYS:
+                    current[k] = []
+
+            if self.dedupe and not any(current.get(k) for k in INCREMENTAL_KEYS):
+                signature = json.dumps(
+                    dict((k, v) for (k, v) in current.items() if k != 'serverTime' and k not in INCREMENTAL_KEYS),
+                    sort_keys=True, default=str)
+                if signature == self.last_signature:
+                    return
+                self.last_signature = signature
+            else:
+                self.last_signature = None
+
+            self.last_sent_ts = time.time()
+            self.send_messages([{'current': current}])
+
+    def send_messages(self, messages):
+        if self.sockjs:
+            self.send('a' + json.dumps(messages))
+        else:
+            for msg in messages:
+                self.send(json.dumps(msg))
+
+    def close(self):
+        with self._mutex:
+            if self.flush_timer:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            self.pending_current = None
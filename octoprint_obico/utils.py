@@ -288,7 +288,7 @@ def server_request(method, uri, plugin, timeout=30, raise_exception=False, skip_
         error_stats.attempt('server')
         resp = requests.request(method, endpoint, timeout=timeout, **kwargs)
 
-        if not skip_debug_logging:
+        if not skip_debug_logging and _logger.isEnabledFor(logging.DEBUG):
             _logger.debug(curlify.to_curl(resp.request))
 
         if not resp.ok and not resp.status_code == 401:
@@ -6,16 +6,76 @@ import logging
 import threading
 import inspect
 import sys
+from collections import deque
+
+from .lib.moving_histogram import MovingHistogram
 
 _logger = logging.getLogger('octoprint.plugins.obico')
 
+MAX_PENDING_FRAMES = 100
+
 class WebSocketConnectionException(Exception):
     pass
 
+class WebSocketLivenessMonitor:
+    '''
+    Application-level liveness check on top of a WebSocketClient. It pings the other end every `ping_interval`
+    seconds and records the round-trip time of each pong. If nothing (message or pong) has been heard from the other
+    end for `dead_after` seconds, the connection is declared dead and closed, so that the owner reconnects.
+    '''
+
+    def __init__(self, client, ping_interval, dead_after, rtt_histogram=None):
+        self.client = client
+        self.ping_interval = ping_interval
+        self.dead_after = dead_after
+        self.rtt = rtt_histogram if rtt_histogram is not None else MovingHistogram()
+        self.last_heard = time.time()
+        self.dead = False
+        self._stop = threading.Event()
+
+    def start(self):
+        self.heard()
+        monitor_thread = threading.Thread(target=self.monitor_loop)
+        monitor_thread.daemon = True
+        monitor_thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def heard(self):
+        self.last_heard = time.time()
+
+    def on_pong(self, data):
+        self.heard()
+        try:
+            sent_ts = float(data.decode('utf-8') if isinstance(data, bytes) else data)
+        except (ValueError, UnicodeDecodeError):
+            return  # Not a pong to one of our pings
+        self.rtt.add(time.time() - sent_ts)
+
+    def monitor_loop(self):
+        while not self._stop.wait(self.ping_interval):
+            silence = time.time() - self.last_heard
+            if silence > self.dead_after:
+                _logger.warning('Nothing heard from websocket server in {:.0f}s. Closing the connection.'.format(silence))
+                self.dead = True
+                self.client.close()
+                return
+
+            try:
+                self.client.ping('{:.6f}'.format(time.time()))
+            except Exception as e:
+                _logger.warning('Failed to ping websocket server - {}'.format(e))
+
+
 class WebSocketClient:
 
-    def __init__(self, url, token=None, on_ws_msg=None, on_ws_close=None, on_ws_open=None, subprotocols=None, waitsecs=120):
+    def __init__(self, url, token=None, on_ws_msg=None, on_ws_close=None, on_ws_open=None, subprotocols=None, waitsecs=120,
+                 ping_interval=None, dead_after=None, rtt_histogram=None, on_ws_data=None):
         self._mutex = threading.RLock()
+        self.liveness = None
+        if ping_interval:
+            self.liveness = WebSocketLivenessMonitor(self, ping_interval, dead_after or ping_interval * 3, rtt_histogram=rtt_histogram)
 
         def on_error(ws, error):
             _logger.warning('Server WS ERROR: {}'.format(error))
@@ -27,16 +87,29 @@ class WebSocketClient:
             threading.Thread(target=run).start()
 
         def on_message(ws, msg):
+            if self.liveness:
+                self.liveness.heard()
             if on_ws_msg:
                 on_ws_msg(ws, msg)
 
+        # Same as on_message, but also passes the frame opcode so that the receiver knows if it is a text or binary frame
+        def on_data(ws, data, opcode, fin):
+            if on_ws_data and opcode in (websocket.ABNF.OPCODE_TEXT, websocket.ABNF.OPCODE_BINARY):
+                on_ws_data(ws, data, opcode)
+
         def on_close(ws, close_status_code, close_msg):
             _logger.warning('WS Closed - {} - {}'.format(close_status_code, close_msg))
             if on_ws_close:
                 on_ws_close(ws, close_status_code=close_status_code)
 
+        def on_pong(ws, data):
+            if self.liveness:
+                self.liveness.on_pong(data)
+
         def on_open(ws):
             _logger.debug('WS Opened')
+            if self.liveness:
+                self.liveness.start()
 
             def run(*args):
                 if on_ws_open:
@@ -51,9 +124,11 @@ class WebSocketClient:
         self.ws = websocket.WebSocketApp(
             url,
             on_message=on_message,
+            on_data=on_data,
             on_open=on_open,
             on_close=on_close,
             on_error=on_error,
+            on_pong=on_pong,
             header=header,
             subprotocols=subprotocols
         )
@@ -85,15 +160,91 @@ class WebSocketClient:
                 else:
                     self.ws.send(data)
 
+    def ping(self, payload=''):
+        with self._mutex:
+            if self.connected():
+                self.ws.sock.ping(payload)
+
     def connected(self):
         with self._mutex:
+            if self.liveness and self.liveness.dead:
+                return False
             return self.ws.sock and self.ws.sock.connected
 
     def close(self):
         with self._mutex:
+            if self.liveness:
+                self.liveness.stop()
             self.ws.keep_running = False
             self.ws.close()
 
+class BufferedWebSocketClient:
+    '''
+    connect() returns right away and the handshake happens in a background thread, so that neither connecting nor
+    send() blocks. Frames sent before the connection is open are queued, and flushed in order once it is.
+    '''
+
+    def __init__(self, url, on_ws_msg=None, on_ws_close=None, max_pending=MAX_PENDING_FRAMES, **kwargs):
+        self._mutex = threading.RLock()
+        self.url = url
+        self.on_ws_msg = on_ws_msg
+        self.on_ws_close = on_ws_close
+        self.client_kwargs = kwargs
+        self.pending = deque()
+        self.max_pending = max_pending
+        self.client = None
+        self.closed = False
+
+    def connect(self):
+        connect_thread = threading.Thread(target=self._connect)
+        connect_thread.daemon = True
+        connect_thread.start()
+
+    def _connect(self):
+        try:
+            client = WebSocketClient(self.url, on_ws_msg=self.on_ws_msg, on_ws_close=self.on_ws_close, **self.client_kwargs)
+        except Exception as e:
+            _logger.warning('Failed to connect to websocket {} - {}'.format(self.url, e))
+            with self._mutex:
+                self.closed = True
+                self.pending.clear()
+            if self.on_ws_close:
+                self.on_ws_close(None, close_status_code=None)
+            return
+
+        with self._mutex:
+            if self.closed:     # Closed while connecting
+                client.close()
+                return
+            while self.pending:
+                client.send(self.pending.popleft())
+            self.client = client
+
+    def send(self, data, as_binary=False):
+        with self._mutex:
+            if self.closed:
+                return
+            if self.client is None:
+                if len(self.pending) >= self.max_pending:
+                    _logger.warning('Websocket is not open yet and too many frames are pending. Frame dropped')
+                    return
+                self.pending.append(data)
+                return
+            self.client.send(data, as_binary=as_binary)
+
+    def connected(self):
+        with self._mutex:
+            return self.client is not None and self.client.connected()
+
+    def close(self):
+        with self._mutex:
+            self.closed = True
+            self.pending.clear()
+            client = self.client
+        if client:
+            client.close()
+
+
 if __name__ == "__main__":
     import yaml
     import sys